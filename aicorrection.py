@@ -1,11 +1,14 @@
-from typing import List
+from typing import Iterable, Iterator, List
 import os
 from dotenv import load_dotenv
 from openai import OpenAI
 from pydantic import BaseModel
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from settings import OUTPUT_FILES
+from response_cache import ResponseCache, parse_completion
 
 load_dotenv()
 
@@ -36,26 +39,67 @@ Here are the subtitles:
 
 The subtitles need to be properly timed with the video using correct time codes.
 You must correct the words in the subtitles if they do not exist in the English language or if they contain errors.
-Numerate the subtitles.
+Keep the given Subtitle Number of every subtitle unchanged: do not renumber, merge, split or add subtitles.
 
 Answer in JSON Format.
 """
 
-    def __init__(self):
+    def __init__(self, 
+            cache: ResponseCache = None, 
+            window_size: int = 100, 
+            overlap: int = 10, 
+            max_in_flight: int = 4,
+            confidence_threshold: float = None,
+            context: int = 2
+        ):
         self.client = OpenAI(
             api_key=os.getenv("OPENAI_API_KEY")
         )
-
-    def run(self, analysis: dict):
+        self.cache = cache
+        self.window_size = window_size # Субтитров в одном запросе
+        self.overlap = overlap # Общих субтитров у соседних окон
+        self.max_in_flight = max_in_flight
+        # Если задан порог, в LLM уходят только субтитры с confidence ниже него
+        # (плюс context соседей с каждой стороны), остальные не меняются
+        self.confidence_threshold = confidence_threshold
+        self.context = context
+        self.window_stats = []
+        self.skipped_fraction = 0.0
+
+    def select_low_confidence(self, analysis: List[dict]) -> tuple[List[dict], set[int]]:
+        """
+        Возвращает (субтитры для отправки в LLM, номера субтитров, которые нужно исправить).
+        Соседи добавляются только как контекст, их исправления не применяются.
+        """
+        low = [i for i, item in enumerate(analysis) if item["confidence"] < self.confidence_threshold]
+        selected = sorted({
+            j
+            for i in low
+            for j in range(max(0, i - self.context), min(len(analysis), i + self.context + 1))
+        })
+        return [analysis[j] for j in selected], {analysis[i]["subtitle_number"] for i in low}
+
+    def make_windows(self, analysis: List[dict]) -> List[List[dict]]:
+        """Нарезает субтитры на окна по window_size с перекрытием overlap."""
+        step = max(1, self.window_size - self.overlap)
+        windows = []
+        for start in range(0, len(analysis), step):
+            windows.append(analysis[start:start + self.window_size])
+            if start + self.window_size >= len(analysis):
+                break
+        return windows
+
+    def format_subtitles(self, analysis: List[dict]) -> str:
         text = ""
         for analysis_item in analysis:
-            text += f"Subtitle Number: {analysis_item["subtitle_number"]} Start time: {analysis_item['start_timecode']}, End time: {analysis_item['end_timecode']}, Subtitle: {analysis_item['subtitle']}, Confidence: {analysis_item['confidence']}\n\n"
-
-        print(text)
-
-        aicorrection_assistant_prompt = self.task_prompt.format(subtitles=text)
-        open(f"aicorrection_output/aicorrection_assistant_prompt.txt", "w", encoding="utf-8").write(aicorrection_assistant_prompt)
-        response = self.client.beta.chat.completions.parse(
+            text += f"Subtitle Number: {analysis_item['subtitle_number']} Start time: {analysis_item['start_timecode']}, End time: {analysis_item['end_timecode']}, Subtitle: {analysis_item['subtitle']}, Confidence: {analysis_item['confidence']}\n\n"
+        return text
+
+    def correct_window(self, prompt: str) -> tuple[List[dict], dict, float]:
+        started = time.perf_counter()
+        content, usage = parse_completion(
+            self.client,
+            self.cache,
             model="gpt-4o-2024-08-06",
             messages=[
                 {
@@ -64,17 +108,137 @@ Answer in JSON Format.
                 },
                 {
                     "role": "user",
-                    "content": aicorrection_assistant_prompt
+                    "content": prompt
                 }
             ],
             response_format=Subtitles
         )
-        
-        completion_tokens = response.usage.completion_tokens
-        prompt_tokens = response.usage.prompt_tokens
-        total_tokens = response.usage.total_tokens
-
-        analysis = response.choices[0].message.content
-        parsed_response_content = json.loads(analysis)
+        return json.loads(content)["subtitles"], usage, time.perf_counter() - started
+
+    def stitch(self, analysis: List[dict], windows: List[List[dict]], corrected: List[List[dict]]) -> List[dict]:
+        """
+        Собирает ответы окон обратно по subtitle_number.
+        В перекрытиях берётся вариант из окна, где субтитр дальше от края окна.
+        Номера, которых не было в окне (например, модель перенумеровала субтитры с 1), отбрасываются
+        и считаются в window_stats[...]["dropped"]; пропущенные моделью субтитры (обрезанный ответ)
+        остаются без исправлений.
+        """
+        best = {}  # subtitle_number -> (расстояние до края окна, субтитр)
+        for index, (window, window_corrected) in enumerate(zip(windows, corrected)):
+            positions = {item["subtitle_number"]: i for i, item in enumerate(window)}
+            dropped = 0
+            for item in window_corrected:
+                position = positions.get(item["subtitle_number"])
+                if position is None:
+                    dropped += 1
+                    continue
+                distance = min(position, len(window) - 1 - position)
+                if item["subtitle_number"] not in best or distance > best[item["subtitle_number"]][0]:
+                    best[item["subtitle_number"]] = (distance, item)
+
+            if index < len(self.window_stats):
+                self.window_stats[index]["dropped"] = dropped
+            if dropped:
+                print(f"[AICorrection] - [stitch] - Window {index}: dropped {dropped} of {len(window_corrected)} "
+                      f"subtitles with numbers outside {window[0]['subtitle_number']}..{window[-1]['subtitle_number']}")
+
+        missing = [item for item in analysis if item["subtitle_number"] not in best]
+        if missing:
+            print(f"[AICorrection] - [stitch] - {len(missing)} subtitles missing from responses, kept uncorrected")
+
+        return [best[item["subtitle_number"]][1] if item["subtitle_number"] in best else item for item in analysis]
+
+    def iter_windows(self, entries: Iterator[dict], buffer: List[dict]) -> Iterator[List[dict]]:
+        """
+        Те же окна, что make_windows, но по мере поступления субтитров:
+        окно отдаётся, как только в buffer набралось window_size субтитров от его начала.
+        """
+        step = max(1, self.window_size - self.overlap)
+        start = 0
+        for entry in entries:
+            buffer.append(entry)
+            if len(buffer) == start + self.window_size:
+                yield buffer[start:start + self.window_size]
+                start += step
+
+        # Хвост: окна, которые make_windows построил бы после конца потока
+        while start < len(buffer) and (start == 0 or start - step + self.window_size < len(buffer)):
+            yield buffer[start:start + self.window_size]
+            if start + self.window_size >= len(buffer):
+                break
+            start += step
+
+    def write_prompts(self, prompts: List[str]) -> None:
+        open(f"aicorrection_output/aicorrection_assistant_prompt.txt", "w", encoding="utf-8").write(
+            ("\n" + 40 * "=" + "\n").join(prompts)
+        )
 
-        return parsed_response_content, total_tokens
+    def collect(self, windows: List[List[dict]], results: list) -> int:
+        self.window_stats = []
+        total_tokens = 0
+        for index, (window, (_, usage, latency)) in enumerate(zip(windows, results)):
+            total_tokens += usage["total_tokens"]
+            self.window_stats.append({
+                "window": index,
+                "first_subtitle": window[0]["subtitle_number"],
+                "last_subtitle": window[-1]["subtitle_number"],
+                "latency_seconds": round(latency, 3),
+                **usage
+            })
+            print(f"[AICorrection] - [run] - Window {index}: {self.window_stats[-1]}")
+        return total_tokens
+
+    def run_stream(self, entries: Iterable[dict]):
+        """
+        Коррекция субтитров, которые ещё распознаются: окно уходит в LLM,
+        как только для него пришли все субтитры, не дожидаясь конца распознавания.
+        Результат такой же, как у run(list(entries)) без порога уверенности.
+        """
+        analysis, windows, prompts, futures = [], [], [], []
+        with ThreadPoolExecutor(max_workers=max(1, self.max_in_flight)) as executor:
+            for window in self.iter_windows(iter(entries), analysis):
+                windows.append(window)
+                prompts.append(self.task_prompt.format(subtitles=self.format_subtitles(window)))
+                futures.append(executor.submit(self.correct_window, prompts[-1]))
+            results = [future.result() for future in futures]
+
+        self.write_prompts(prompts)
+        total_tokens = self.collect(windows, results)
+        subtitles = self.stitch(analysis, windows, [corrected for corrected, _, _ in results])
+        return {"subtitles": subtitles}, total_tokens
+
+    def run(self, analysis: Iterable[dict]):
+        """
+        analysis - список субтитров или итератор (например, потоковое распознавание).
+        Итератор без порога уверенности корректируется по мере поступления (run_stream);
+        для отбора по уверенности нужны все субтитры сразу.
+        """
+        if not isinstance(analysis, list):
+            if self.confidence_threshold is None:
+                return self.run_stream(analysis)
+            analysis = list(analysis)
+
+        if self.confidence_threshold is None:
+            to_correct, gated = analysis, None
+        else:
+            to_correct, gated = self.select_low_confidence(analysis)
+            self.skipped_fraction = 1 - len(gated) / len(analysis) if analysis else 0.0
+            print(f"[AICorrection] - [run] - {len(gated)} of {len(analysis)} subtitles below confidence "
+                  f"{self.confidence_threshold}, sending {len(to_correct)} with context, "
+                  f"skipped fraction {self.skipped_fraction:.2%}")
+
+        windows = self.make_windows(to_correct)
+        prompts = [self.task_prompt.format(subtitles=self.format_subtitles(window)) for window in windows]
+        self.write_prompts(prompts)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_in_flight)) as executor:
+            results = list(executor.map(self.correct_window, prompts))
+
+        total_tokens = self.collect(windows, results)
+        subtitles = self.stitch(to_correct, windows, [corrected for corrected, _, _ in results])
+
+        if gated is not None:
+            corrected_by_number = {item["subtitle_number"]: item for item in subtitles if item["subtitle_number"] in gated}
+            subtitles = [corrected_by_number.get(item["subtitle_number"], item) for item in analysis]
+
+        return {"subtitles": subtitles}, total_tokens
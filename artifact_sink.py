@@ -0,0 +1,58 @@
+import json
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class ArtifactSink():
+    """
+    Асинхронная запись промежуточных JSON артефактов пайплайна.
+    Этапы передают друг другу объекты Python напрямую, а запись на диск
+    идёт в фоновом потоке и не задерживает следующий этап.
+    Переданные объекты нельзя менять после write до close.
+    compact=True - JSON без отступов (для больших прогонов).
+    enabled=False - ничего не записывается.
+    """
+    def __init__(self, compact: bool = False, enabled: bool = True):
+        self.compact = compact
+        self.enabled = enabled
+        self._executor = ThreadPoolExecutor(max_workers=1) if enabled else None
+        self._pending: list[Future] = []
+
+    def _dump(self, path: str, data) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(path, 'w', encoding='utf-8') as file:
+            if self.compact:
+                json.dump(data, file, ensure_ascii=False, separators=(',', ':'))
+            else:
+                json.dump(data, file, ensure_ascii=False, indent=4)
+
+    def write(self, path: str, data) -> None:
+        if not self.enabled or path is None:
+            return
+        self._pending.append(self._executor.submit(self._dump, path, data))
+
+    def close(self) -> None:
+        """Дожидается всех записей; ошибки записи пробрасываются здесь."""
+        if self._executor is None:
+            return
+        try:
+            for future in self._pending:
+                future.result()
+        finally:
+            self._pending = []
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.close()
+        except Exception:
+            # Ошибка записи не должна подменять исключение самого пайплайна
+            if exc_type is None:
+                raise
@@ -0,0 +1,72 @@
+import random
+import time
+
+from final_analysis import VideoAnalysisBySubtitles
+from video_analysis import VideoAnalysis
+
+
+def naive_join(video_analysis: list[dict], subtitles: list[dict]) -> list[dict]:
+    """Старая реализация video_subtitles_concat: каждое окно сравнивается с каждым субтитром."""
+    combined_analysis = []
+    for va in video_analysis:
+        va_start = VideoAnalysisBySubtitles.timecode_to_seconds(va["start_timecode"])
+        va_end = VideoAnalysisBySubtitles.timecode_to_seconds(va["end_timecode"])
+
+        matching_subtitles = []
+        for st in subtitles:
+            st_start = st["start_timecode"]
+            st_end = st["end_timecode"]
+
+            if (va_start <= st_start <= va_end) or (va_start <= st_end <= va_end) or (st_start <= va_start <= st_end):
+                matching_subtitles.append(st)
+
+        combined_analysis.append({
+            "video_analysis": va,
+            "subtitles_analysis": matching_subtitles
+        })
+    return combined_analysis
+
+
+def make_data(duration_seconds: int, window_seconds: float, words_per_second: float = 2.5):
+    video_analysis = [
+        {
+            "start_timecode": VideoAnalysis.format_timecode(start),
+            "end_timecode": VideoAnalysis.format_timecode(start + window_seconds)
+        }
+        for start in [i * window_seconds for i in range(int(duration_seconds / window_seconds))]
+    ]
+
+    subtitles = []
+    t = 0.0
+    while t < duration_seconds:
+        length = random.uniform(0.1, 1.5)
+        subtitles.append({
+            "subtitle_number": len(subtitles) + 1,
+            "start_timecode": t,
+            "end_timecode": t + length,
+            "subtitle": "word"
+        })
+        t += 1 / words_per_second
+    return video_analysis, subtitles
+
+
+def measure(function, *args, repeat: int = 3) -> tuple[float, list]:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    for duration, window in [(600, 10), (3600, 5), (7200, 1)]:
+        video_analysis, subtitles = make_data(duration, window)
+        naive_seconds, naive_result = measure(naive_join, video_analysis, subtitles)
+        sorted_seconds, sorted_result = measure(VideoAnalysisBySubtitles.join_subtitles, video_analysis, subtitles)
+        assert naive_result == sorted_result
+
+        print(f"{duration}s video, {len(video_analysis)} windows x {len(subtitles)} subtitles: "
+              f"naive {naive_seconds * 1000:.1f} ms, bisect {sorted_seconds * 1000:.1f} ms, "
+              f"x{naive_seconds / sorted_seconds:.1f}")
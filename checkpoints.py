@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+from typing import Callable, Iterable
+
+STAGES = (
+    "video_analysis",
+    "transcription",
+    "correction",
+    "concat",
+    "assistant_1",
+    "assistant_2",
+    "crops",
+    "vertical_clips",
+)
+
+
+def file_hash(path: str, block_size: int = 1024 * 1024) -> str:
+    """sha256 содержимого файла, читается блоками."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def data_hash(data) -> str:
+    """
+    Хэш результата этапа. Входит в параметры следующих этапов, чтобы
+    пересчёт этапа (например, через force_stages) инвалидировал все зависящие от него.
+    """
+    payload = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class CheckpointStore():
+    """
+    Чекпоинты этапов пайплайна.
+    Ключ этапа - хэш входа (содержимое файла или ссылка на YouTube)
+    плюс имя этапа и его параметры. При повторном запуске этап
+    с валидным чекпоинтом не выполняется, результат берётся с диска.
+    force_stages - этапы, которые нужно пересчитать в любом случае.
+    reused_tokens - токены этапов, взятых из чекпоинтов (потрачены в прошлых запусках).
+    """
+    def __init__(self, checkpoint_dir: str, input_key: str, force_stages: Iterable[str] = ()):
+        unknown = set(force_stages) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+        self.checkpoint_dir = checkpoint_dir
+        self.input_key = input_key
+        self.force_stages = set(force_stages)
+        self.reused = []
+        self.reused_tokens = {}
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    @classmethod
+    def for_input(cls, checkpoint_dir: str, video_path: str = None, youtube_video_url: str = None,
+                  force_stages: Iterable[str] = ()) -> "CheckpointStore":
+        if video_path is not None:
+            input_key = file_hash(video_path)
+        else:
+            input_key = hashlib.sha256(youtube_video_url.encode("utf-8")).hexdigest()
+        return cls(checkpoint_dir, input_key, force_stages)
+
+    def _path(self, stage: str, params: dict) -> str:
+        payload = json.dumps([self.input_key, stage, params], ensure_ascii=False, sort_keys=True, default=str)
+        key = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.checkpoint_dir, f"{stage}-{key}.json")
+
+    def is_forced(self, stage: str) -> bool:
+        return stage in self.force_stages
+
+    def load(self, stage: str, params: dict):
+        """Возвращает (найден ли чекпоинт, данные)."""
+        if stage in self.force_stages:
+            return False, None
+
+        try:
+            with open(self._path(stage, params), "r", encoding="utf-8") as file:
+                checkpoint = json.load(file)
+        except (OSError, ValueError):
+            return False, None
+
+        if checkpoint.get("stage") != stage or checkpoint.get("input_key") != self.input_key:
+            return False, None
+        return True, checkpoint["data"]
+
+    def save(self, stage: str, params: dict, data) -> None:
+        path = self._path(stage, params)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {"stage": stage, "input_key": self.input_key, "params": params, "data": data},
+                file,
+                ensure_ascii=False,
+                default=str
+            )
+        os.replace(tmp_path, path)  # Незаконченный чекпоинт не должен выглядеть валидным
+
+    def cached(self, stage: str, params: dict, compute: Callable[[], object],
+               validate: Callable[[object], bool] = None, tokens: Callable[[object], int] = None):
+        """
+        Результат этапа из чекпоинта или compute() с сохранением.
+        validate - дополнительная проверка чекпоинта (например, что файлы клипов на месте).
+        tokens - сколько токенов записано в результате этапа; для взятого из чекпоинта
+        этапа они попадают в reused_tokens, а не в расход текущего запуска.
+        """
+        found, data = self.load(stage, params)
+        if found and (validate is None or validate(data)):
+            print(f"[CheckpointStore] - [cached] - Reusing checkpoint for stage {stage}")
+            self.reused.append(stage)
+            if tokens is not None:
+                self.reused_tokens[stage] = tokens(data)
+            return data
+
+        data = compute()
+        self.save(stage, params, data)
+        return data
+
+    @property
+    def run_id(self) -> str:
+        """Стабильный идентификатор запуска для имён выходных файлов."""
+        return self.input_key[:12]
+
+
+def run_stage(checkpoints: CheckpointStore, stage: str, params: dict, compute: Callable[[], object],
+              validate: Callable[[object], bool] = None, tokens: Callable[[object], int] = None):
+    """Выполняет этап через чекпоинты, а без них (checkpoints=None) - просто вызывает compute()."""
+    if checkpoints is None:
+        return compute()
+    return checkpoints.cached(stage, params, compute, validate, tokens)
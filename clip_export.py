@@ -0,0 +1,258 @@
+import os
+import re
+import subprocess
+import tempfile
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpeg
+
+FFMPEG_CMD = ['ffmpeg', '-nostdin']
+
+EXPORT_MODES = (
+    "reencode", # Полное перекодирование клипа (по умолчанию)
+    "copy",     # Копирование потоков с ближайшего предыдущего ключевого кадра, без перекодирования
+    "accurate", # Перекодируется только неполный GOP в начале клипа (только H.264), остальное копируется
+)
+
+# Профили H.264 из ffprobe -> значения -profile:v для libx264
+X264_PROFILES = {"Baseline": "baseline", "Constrained Baseline": "baseline", "Main": "main", "High": "high"}
+
+
+def probe_video_stream(video_path: str) -> dict:
+    """Параметры видеопотока, нужные для нарезки: кодек, профиль, уровень, частота кадров, start_time, есть ли звук."""
+    probe = ffmpeg.probe(video_path)
+    stream = next(stream for stream in probe['streams'] if stream['codec_type'] == 'video')
+    numerator, _, denominator = stream.get('r_frame_rate', '25/1').partition('/')
+    return {
+        "codec_name": stream.get('codec_name'),
+        "profile": stream.get('profile'),
+        "level": stream.get('level'),
+        "pix_fmt": stream.get('pix_fmt'),
+        "time_base": stream.get('time_base'),
+        "fps": float(numerator) / float(denominator or 1),
+        "start_time": float(probe['format'].get('start_time', 0) or 0),
+        "has_audio": any(stream['codec_type'] == 'audio' for stream in probe['streams']),
+    }
+
+
+def probe_keyframes(video_path: str, start_time: float = 0.0) -> list[float]:
+    """
+    Позиции ключевых кадров видеопотока в секундах от начала файла (pts_time - start_time контейнера),
+    то есть в той же шкале, что и -ss. Декодируются только ключевые кадры.
+    """
+    out = subprocess.run(
+        [
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-skip_frame', 'nokey',
+            '-show_entries', 'frame=pts_time',
+            '-of', 'csv=p=0',
+            video_path
+        ],
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+    return sorted(
+        float(line.strip(',')) - start_time
+        for line in out.split()
+        if line.strip(',') not in ('', 'N/A')
+    )
+
+
+def probe_duration(path: str) -> float:
+    return float(ffmpeg.probe(path)['format']['duration'])
+
+
+def safe_filename(title: str, max_length: int = 80) -> str:
+    """Имя файла из заголовка клипа: без разделителей путей, пробелов и служебных символов."""
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', '_', title.strip())
+    name = re.sub(r'\s+', '_', name).strip('._')
+    return name[:max_length] or "clip"
+
+
+class ClipExporter():
+    """
+    Нарезка клипов из видео через ffmpeg.
+    mode - см. EXPORT_MODES. "accurate" включается только явно: он применяется к H.264 с известным
+    профилем, голова кодируется с параметрами исходного потока, а результат проверяется по длительности;
+    в остальных случаях клип перекодируется целиком.
+    keyframe_tolerance - в режиме "accurate", если начало клипа отстоит от предыдущего ключевого кадра
+    не больше чем на столько секунд, клип копируется целиком (без перекодирования).
+    threads - потоки кодировщика на один процесс ffmpeg, workers - число клипов,
+    экспортируемых одновременно в export_many. По умолчанию ядра делятся между workers.
+    Время экспорта каждого клипа сохраняется в self.timings.
+    """
+    def __init__(self, mode: str = "reencode", keyframe_tolerance: float = 0.1, threads: int = None, workers: int = 1):
+        if mode not in EXPORT_MODES:
+            raise ValueError(f"Invalid export mode: {mode}")
+
+        self.mode = mode
+        self.keyframe_tolerance = keyframe_tolerance
+        self.workers = max(1, workers)
+        # Потоки кодировщика ffmpeg: workers процессов не должны каждый занимать все ядра
+        self.threads = threads if threads is not None else max(1, (os.cpu_count() or 1) // self.workers)
+        self.timings = [] # (режим, путь, секунды)
+        self._streams = {}
+        self._keyframes = {}
+
+    def stream_info(self, video_path: str) -> dict:
+        if video_path not in self._streams:
+            self._streams[video_path] = probe_video_stream(video_path)
+        return self._streams[video_path]
+
+    def keyframes(self, video_path: str) -> list[float]:
+        if video_path not in self._keyframes:
+            self._keyframes[video_path] = probe_keyframes(video_path, self.stream_info(video_path)["start_time"])
+        return self._keyframes[video_path]
+
+    def _run(self, stream) -> None:
+        stream.overwrite_output().run(cmd=FFMPEG_CMD, capture_stdout=True, capture_stderr=True)
+
+    def _reencode(self, video_path: str, start: float, end: float, output_path: str) -> None:
+        self._run(
+            ffmpeg
+            .input(video_path, ss=start)
+            .output(output_path, t=end - start, vcodec='libx264', acodec='aac', threads=self.threads)
+        )
+
+    def _copy(self, video_path: str, start: float, end: float, output_path: str) -> None:
+        # -ss перед -i при копировании потоков начинает с ключевого кадра не позже start
+        self._run(
+            ffmpeg
+            .input(video_path, ss=start)
+            .output(output_path, t=end - start, c='copy', avoid_negative_ts='make_zero')
+        )
+
+    def can_smart_cut(self, video_path: str) -> bool:
+        """Голову можно закодировать совместимо с исходным потоком только для H.264 с известным профилем."""
+        info = self.stream_info(video_path)
+        return info["codec_name"] == "h264" and info["profile"] in X264_PROFILES and info["level"] not in (None, -99)
+
+    def _head_reencode(self, video_path: str, start: float, end: float, next_keyframe: float, output_path: str) -> None:
+        """
+        Видео: [start, next_keyframe) перекодируется с профилем, уровнем, форматом пикселей и шкалой времени
+        исходного потока, [next_keyframe, end) копируется; части склеиваются в MPEG-TS (SPS/PPS идут
+        внутри потока, поэтому разные параметры кодировщиков не ломают декодирование).
+        Звук всего клипа (если он есть) кодируется одним куском и добавляется в конце, без стыка посередине.
+        """
+        info = self.stream_info(video_path)
+        # Половина кадра после ключевого кадра, чтобы -ss не попал на предыдущий GOP из-за округления pts_time
+        tail_seek = next_keyframe + 0.5 / info["fps"]
+        time_scale = info["time_base"].partition('/')[2] if info["time_base"] else None
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            head_path = os.path.join(tmp_dir, "head.ts")
+            tail_path = os.path.join(tmp_dir, "tail.ts")
+            video_path_joined = os.path.join(tmp_dir, "video.ts")
+
+            self._run(
+                ffmpeg
+                .input(video_path, ss=start)
+                .output(
+                    head_path,
+                    t=next_keyframe - start,
+                    an=None,
+                    vcodec='libx264',
+                    pix_fmt=info["pix_fmt"],
+                    threads=self.threads,
+                    **{'profile:v': X264_PROFILES[info["profile"]], 'level': f'{info["level"] / 10:.1f}'}
+                )
+            )
+            self._run(
+                ffmpeg
+                .input(video_path, ss=tail_seek)
+                .output(tail_path, t=end - next_keyframe, an=None, vcodec='copy', **{'bsf:v': 'h264_mp4toannexb'})
+            )
+            self._run(
+                ffmpeg
+                .input(f"concat:{head_path}|{tail_path}")
+                .output(video_path_joined, c='copy')
+            )
+
+            streams = [ffmpeg.input(video_path_joined).video]
+            output_args = {'video_track_timescale': time_scale} if time_scale else {}
+            if info["has_audio"]:
+                streams.append(ffmpeg.input(video_path, ss=start, t=end - start).audio)
+                output_args.update(acodec='aac', shortest=None)
+            self._run(ffmpeg.output(*streams, output_path, vcodec='copy', **output_args))
+
+    def _continuous(self, output_path: str, expected_duration: float, fps: float) -> bool:
+        """Длительность результата совпадает с запрошенной с точностью до двух кадров (нет пропущенного или лишнего GOP)."""
+        try:
+            return abs(probe_duration(output_path) - expected_duration) <= 2 / fps
+        except (ffmpeg.Error, KeyError, ValueError):
+            return False
+
+    def export(self, video_path: str, start: float, end: float, output_path: str) -> str:
+        """Экспортирует клип [start, end) секунд. Возвращает фактически использованный режим."""
+        started = time.perf_counter()
+        mode = self.mode
+
+        if mode == "copy":
+            self._copy(video_path, start, end, output_path)
+        elif mode == "accurate" and self.can_smart_cut(video_path):
+            keyframes = self.keyframes(video_path)
+            index = bisect_right(keyframes, start)
+            previous_keyframe = keyframes[index - 1] if index > 0 else 0.0
+            next_keyframe = keyframes[index] if index < len(keyframes) else None
+
+            if start - previous_keyframe <= self.keyframe_tolerance:
+                mode = "copy"
+                self._copy(video_path, start, end, output_path)
+            elif next_keyframe is None or next_keyframe >= end:
+                # Весь клип внутри одного GOP - копировать нечего
+                mode = "reencode"
+                self._reencode(video_path, start, end, output_path)
+            else:
+                try:
+                    self._head_reencode(video_path, start, end, next_keyframe, output_path)
+                    failure = None
+                    if not self._continuous(output_path, end - start, self.stream_info(video_path)["fps"]):
+                        failure = "failed the duration check"
+                except ffmpeg.Error as e:
+                    failure = f"failed in ffmpeg ({(e.stderr or b'').decode(errors='replace').strip()[-200:]})"
+                if failure is not None:
+                    print(f"[ClipExporter] - [export] - {output_path}: smart cut {failure}, re-encoding")
+                    mode = "reencode"
+                    self._reencode(video_path, start, end, output_path)
+        else:
+            mode = "reencode"
+            self._reencode(video_path, start, end, output_path)
+
+        elapsed = time.perf_counter() - started
+        self.timings.append((mode, output_path, elapsed))
+        print(f"[ClipExporter] - [export] - {output_path}: {mode}, {elapsed:.2f}s for {end - start:.1f}s of video")
+        return mode
+
+    def export_many(self, video_path: str, clips: list[tuple[float, float, str]]) -> list[str]:
+        """
+        Экспортирует клипы (start, end, output_path) параллельно в self.workers процессах ffmpeg.
+        Возвращает режимы в порядке clips; ошибка любого клипа пробрасывается.
+        """
+        if self.mode == "accurate" and self.can_smart_cut(video_path):
+            self.keyframes(video_path) # Один ffprobe на все клипы, до запуска пула
+
+        if self.workers <= 1 or len(clips) <= 1:
+            return [self.export(video_path, *clip) for clip in clips]
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.export, video_path, *clip) for clip in clips]
+            modes = [future.result() for future in futures]
+
+        print(f"[ClipExporter] - [export_many] - {len(clips)} clips in {time.perf_counter() - started:.2f}s with {self.workers} workers")
+        return modes
+
+    def stats(self) -> dict:
+        """Число клипов и среднее время экспорта клипа по режимам."""
+        stats = {}
+        for mode, _, elapsed in self.timings:
+            count, total = stats.get(mode, (0, 0.0))
+            stats[mode] = (count + 1, total + elapsed)
+        return {
+            mode: {"clips": count, "seconds_per_clip": round(total / count, 3)}
+            for mode, (count, total) in stats.items()
+        }
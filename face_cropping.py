@@ -1,84 +1,353 @@
 import cv2
+import math
+import multiprocessing
+import os
 import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import moviepy.editor as mpe
-from moviepy.config import change_settings
-change_settings({"IMAGEMAGICK_BINARY": r"C:\Program Files\ImageMagick-7.1.1-Q16-HDRI\magick.exe"})
-import mediapipe as mp
+import ffmpeg
+
+from clip_export import FFMPEG_CMD
+
 
+class CenterFilter():
+    """
+    Фильтр Калмана с постоянной скоростью для координаты x центра (доли ширины кадра).
+    predict выполняется на каждом кадре, correct - только на кадрах с измерением.
+    process_noise и measurement_noise заданы на один интервал между детекциями:
+    шум процесса на кадр делится на steps_per_measurement, поэтому сглаживание
+    не зависит от того, как часто запускается детектор.
+    По умолчанию: дрожание детектора ~0.02 ширины (4e-4) и почти неподвижный центр (1e-5).
+    """
+    def __init__(self, process_noise: float = 1e-5, measurement_noise: float = 4e-4, steps_per_measurement: int = 1):
+        self.kalman = cv2.KalmanFilter(2, 1)
+        self.kalman.transitionMatrix = np.array([[1, 1], [0, 1]], np.float32)
+        self.kalman.measurementMatrix = np.array([[1, 0]], np.float32)
+        self.kalman.processNoiseCov = np.eye(2, dtype=np.float32) * (process_noise / max(1, steps_per_measurement))
+        self.kalman.measurementNoiseCov = np.array([[measurement_noise]], np.float32)
+        self.measurement_noise = measurement_noise
+        self.center = None
 
-def crop_and_rotate_video(input_video, output_video, size=(720, 1280)):
-    mp_face_detection = mp.solutions.face_detection
-    face_detection = mp_face_detection.FaceDetection(model_selection=1, min_detection_confidence=0.5)
+    def update(self, measured: float = None) -> float:
+        """Сглаженная координата для очередного кадра или None, пока не было ни одного измерения."""
+        if self.center is None:
+            if measured is not None:
+                # Начальная неопределённость - порядка шума одного измерения
+                self.kalman.statePost = np.array([[measured], [0]], np.float32)
+                self.kalman.errorCovPost = np.eye(2, dtype=np.float32) * self.measurement_noise
+                self.center = measured
+            return self.center
 
-    clip = mpe.VideoFileClip(input_video, audio=True)
+        predicted = float(self.kalman.predict()[0, 0])
+        if measured is not None:
+            predicted = float(self.kalman.correct(np.array([[measured]], np.float32))[0, 0])
+        self.center = min(max(predicted, 0.0), 1.0)
+        return self.center
 
-    original_width, original_height = clip.size
-    is_horizontal = original_width > original_height
 
-    if is_horizontal:
-        clip = clip.rotate(90)
+class FaceTracker():
+    """
+    Центр кадрирования по лицу.
+    Детектор запускается раз в detect_every кадров на уменьшенной до detection_width
+    копии кадра (координаты MediaPipe относительные, поэтому переносятся на полный кадр как есть).
+    Между детекциями и при пропаже лица центр берётся из фильтра Калмана
+    (CenterFilter), который также сглаживает дрожание детектора.
+    Из нескольких лиц выбирается ближайшее к текущему центру, а не первое в списке.
+    detect_every=1, detection_width=None, smooth=False - детекция на каждом полном кадре без сглаживания.
+    """
+    def __init__(self,
+            detect_every: int = 5,
+            detection_width: int = 320,
+            smooth: bool = True,
+            process_noise: float = 1e-5,
+            measurement_noise: float = 4e-4,
+            min_detection_confidence: float = 0.5
+        ):
+        import mediapipe as mp # Нужен только для детекции; CenterFilter работает без него
 
-    current_face = None
-    last_frame = None
-    output_resolution = size
+        self.detect_every = max(1, detect_every)
+        self.detection_width = detection_width
+        self.smooth = smooth
+        self.face_detection = mp.solutions.face_detection.FaceDetection(
+            model_selection=1,
+            min_detection_confidence=min_detection_confidence
+        )
 
-    def crop_video_frame(get_frame, t):
-        nonlocal current_face, last_frame
+        self.filter = CenterFilter(process_noise, measurement_noise, steps_per_measurement=self.detect_every)
 
-        # Get the current frame at time `t`
-        frame = get_frame(t)
+        self.center = None # Относительная координата x центра (0..1)
+        self.frame_index = 0
+        self.detector_calls = 0
+        self.detector_seconds = 0.0
+
+    def detect(self, frame: np.ndarray) -> float:
+        """Относительная координата x центра выбранного лица или None. frame - RGB."""
         height, width, _ = frame.shape
+        if self.detection_width is not None and width > self.detection_width:
+            small_size = (self.detection_width, max(1, round(height * self.detection_width / width)))
+            frame = cv2.resize(frame, small_size, interpolation=cv2.INTER_AREA)
+
+        started = time.perf_counter()
+        results = self.face_detection.process(frame)
+        self.detector_seconds += time.perf_counter() - started
+        self.detector_calls += 1
+
+        if not results.detections:
+            return None
+
+        centers = []
+        for detection in results.detections:
+            bbox = detection.location_data.relative_bounding_box
+            centers.append(bbox.xmin + bbox.width / 2)
+
+        if self.center is None:
+            return centers[0] # Детекции отсортированы по уверенности
+        return min(centers, key=lambda center: abs(center - self.center))
+
+    def update(self, frame: np.ndarray) -> float:
+        """Относительная координата x центра кадрирования для очередного кадра или None, пока лицо не найдено."""
+        measured = None
+        if self.frame_index % self.detect_every == 0:
+            measured = self.detect(frame)
+        self.frame_index += 1
+
+        if not self.smooth:
+            if measured is not None:
+                self.center = measured
+            return self.center
+
+        # Скорость измеряется в долях ширины за кадр; без измерения работает только предсказание
+        self.center = self.filter.update(measured)
+        return self.center
+
+    def stats(self, duration_seconds: float) -> dict:
+        return {
+            "detector_calls": self.detector_calls,
+            "detector_calls_per_second": round(self.detector_calls / duration_seconds, 2) if duration_seconds else 0,
+            "detector_seconds": round(self.detector_seconds, 2)
+        }
+
+    def close(self) -> None:
+        self.face_detection.close()
+
+
+def stream_rotation(video_stream: dict) -> int:
+    """
+    Поворот видео в градусах из тега rotate (старые ffmpeg) или side data displaymatrix.
+    Так записывает ориентацию камера телефона; ffmpeg при декодировании поворачивает кадры сам.
+    """
+    rotation = video_stream.get('tags', {}).get('rotate')
+    if rotation is None:
+        rotation = next(
+            (side_data['rotation'] for side_data in video_stream.get('side_data_list', []) if 'rotation' in side_data),
+            0
+        )
+    return int(float(rotation)) % 360
+
+
+def probe_video(input_video: str) -> dict:
+    """Размеры - уже с учётом поворота, как у декодированных кадров."""
+    probe = ffmpeg.probe(input_video)
+    video_stream = next(stream for stream in probe['streams'] if stream['codec_type'] == 'video')
+    rotation = stream_rotation(video_stream)
+    width, height = int(video_stream['width']), int(video_stream['height'])
+    if rotation in (90, 270):
+        width, height = height, width
+    return {
+        "width": width,
+        "height": height,
+        "rotation": rotation,
+        "frame_rate": video_stream['r_frame_rate'], # Строка вида 30000/1001, передаётся в ffmpeg как есть
+        "has_audio": any(stream['codec_type'] == 'audio' for stream in probe['streams'])
+    }
+
+
+def eval_frame_rate(frame_rate: str) -> float:
+    numerator, _, denominator = frame_rate.partition('/')
+    return float(numerator) / float(denominator or 1)
+
+
+def frame_geometry(width: int, height: int, size=(720, 1280)) -> dict:
+    """
+    Масштаб кадра (width x height - с учётом поворота) под клип size без поворота:
+    кадр масштабируется так, чтобы покрыть клип (scale-to-cover), лишняя высота обрезается
+    по центру в ffmpeg, а лишняя ширина - столбец вокруг лица в crop_and_rotate_video.
+    track - есть ли что кадрировать по горизонтали (источник шире клипа по соотношению сторон).
+    """
+    output_width, output_height = size
+    scale = max(output_width / width, output_height / height)
+    # Чётные размеры для yuv420p, не меньше клипа
+    scaled_width = max(output_width, math.ceil(width * scale / 2) * 2)
+    scaled_height = max(output_height, math.ceil(height * scale / 2) * 2)
+    return {
+        "scaled_width": scaled_width,
+        "scaled_height": scaled_height,
+        "track": width * output_height > output_width * height
+    }
+
+
+def crop_and_rotate_video(input_video, output_video, size=(720, 1280), detect_every=5, detection_width=320, smooth=True,
+                          start=None, end=None, threads=None):
+    """
+    Вертикальный клип с кадрированием по лицу. Параметры слежения - см. FaceTracker.
+    start / end (секунды) - декодируется только этот отрезок исходного видео (-ss перед -i).
+    Кадры не поворачиваются: ffmpeg масштабирует их до высоты клипа (см. frame_geometry)
+    и отдаёт в pipe (RGB), а из горизонтального кадра вырезается столбец ширины клипа
+    вокруг лица - срез NumPy без масштабирования. Если источник не шире клипа
+    по соотношению сторон, кадрировать нечего и детектор не запускается.
+    Срезы пишутся в pipe кодировщика, звук исходного видео добавляется без перекодирования кадров.
+    threads - потоки декодера и libx264 (по умолчанию решает ffmpeg).
+    Если ffmpeg декодирования или кодирования завершился с ошибкой, выбрасывается ffmpeg.Error.
+    Возвращает статистику детектора и время.
+    """
+    started = time.perf_counter()
+    output_width, output_height = size
+
+    info = probe_video(input_video)
+    geometry = frame_geometry(info["width"], info["height"], size)
+    width = geometry["scaled_width"]
+    tracker = FaceTracker(detect_every=detect_every, detection_width=detection_width, smooth=smooth) if geometry["track"] else None
+
+    input_args = {}
+    if start is not None:
+        input_args["ss"] = start
+    if end is not None:
+        input_args["t"] = end - (start or 0)
+    codec_args = {"threads": threads} if threads is not None else {}
+    source = ffmpeg.input(input_video, **input_args, **codec_args)
+    video = (
+        source.video
+        .filter('scale', width, geometry["scaled_height"])
+        .filter('crop', width, output_height) # По центру по вертикали
+    )
+    frame_size = width * output_height * 3
+
+    decoder = (
+        video
+        .output('pipe:', format='rawvideo', pix_fmt='rgb24')
+        .global_args('-loglevel', 'error')
+        .run_async(cmd=FFMPEG_CMD, pipe_stdout=True)
+    )
+    frames = ffmpeg.input(
+        'pipe:',
+        format='rawvideo',
+        pix_fmt='rgb24',
+        s=f'{output_width}x{output_height}',
+        framerate=info["frame_rate"]
+    )
+    streams = [frames, source.audio] if info["has_audio"] else [frames]
+    encoder = (
+        ffmpeg
+        .output(*streams, output_video, vcodec='libx264', pix_fmt='yuv420p', acodec='aac', shortest=None, **codec_args)
+        .global_args('-loglevel', 'error')
+        .overwrite_output()
+        .run_async(pipe_stdin=True) # Без -nostdin: stdin этого процесса - кадры
+    )
+
+    output_frame = np.zeros((output_height, output_width, 3), dtype=np.uint8)
+    n_frames = 0
+    try:
+        while True:
+            buffer = decoder.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+            frame = np.frombuffer(buffer, np.uint8).reshape(output_height, width, 3) # Без копирования
+            n_frames += 1
+
+            if tracker is None:
+                # Кадр уже совпадает с клипом
+                encoder.stdin.write(buffer)
+                continue
+
+            center = tracker.update(frame)
+            if center is None:
+                # Чёрный кадр, пока лицо ещё ни разу не найдено
+                output_frame[:] = 0
+            else:
+                # Calculate the center of the face and define crop bounds
+                left = min(max(int(center * width) - output_width // 2, 0), width - output_width)
+                np.copyto(output_frame, frame[:, left:left + output_width])
+
+            encoder.stdin.write(output_frame.data)
+    finally:
+        encoder.stdin.close()
+        decoder.stdout.close()
+        encoder.wait()
+        decoder.wait()
+        # Release the MediaPipe resources
+        if tracker is not None:
+            tracker.close()
+
+    for name, process in (("decode", decoder), ("encode", encoder)):
+        if process.returncode != 0:
+            raise ffmpeg.Error(f"ffmpeg ({name} {input_video} -> {output_video}, exit code {process.returncode})", None, None)
+
+    if tracker is not None:
+        stats = tracker.stats(n_frames / eval_frame_rate(info["frame_rate"]))
+    else:
+        stats = {"detector_calls": 0, "detector_calls_per_second": 0, "detector_seconds": 0}
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    stats["realtime_factor"] = round(stats["seconds"] * eval_frame_rate(info["frame_rate"]) / max(n_frames, 1), 3)
+    print(f"[crop_and_rotate_video] - {output_video}: {stats}")
+    return stats
+
+
+def _render_vertical_clip(input_video: str, start: float, end: float, output_video: str, size: tuple, threads: int) -> dict:
+    return crop_and_rotate_video(input_video, output_video, size=size, start=start, end=end, threads=threads)
+
+
+def render_vertical_clips(input_video: str, clips: list[tuple[float, float, str]], size=(720, 1280), workers: int = None,
+                          threads: int = None) -> list[dict]:
+    """
+    Вертикальные клипы (start, end, output_path) из одного видео, по процессу на клип.
+    Каждый процесс декодирует только свой отрезок. Возвращает статистику в порядке clips.
+    threads - потоки ffmpeg на клип, по умолчанию ядра делятся между workers (как в ClipExporter).
+    Если какой-то клип не удался, его неполный файл удаляется, остальные клипы дорендериваются,
+    после чего ошибка пробрасывается.
+    """
+    if not clips:
+        return []
+    workers = min(workers or os.cpu_count() or 1, len(clips))
+    threads = threads if threads is not None else max(1, (os.cpu_count() or 1) // workers)
+
+    started = time.perf_counter()
+    stats, errors = [], []
+    # spawn: MediaPipe и ffmpeg-процессы не наследуют состояние родителя
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(_render_vertical_clip, input_video, start, end, output_video, size, threads)
+            for start, end, output_video in clips
+        ]
+        for future, (_, _, output_video) in zip(futures, clips):
+            try:
+                stats.append(future.result())
+            except Exception as e:
+                print(f"[render_vertical_clips] - {output_video} failed: {e}")
+                if os.path.exists(output_video):
+                    os.remove(output_video)
+                stats.append(None)
+                errors.append(e)
+
+    print(f"[render_vertical_clips] - {len(clips) - len(errors)} of {len(clips)} clips in "
+          f"{time.perf_counter() - started:.2f}s with {workers} workers x {threads} threads")
+    if errors:
+        raise errors[0]
+    return stats
+
 
-        # Convert the frame to RGB for MediaPipe processing
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-        # Detect faces using MediaPipe
-        results = face_detection.process(rgb_frame)
-
-        # Check if any faces were detected
-        if results.detections:
-            # Use the first detected face for cropping
-            detection = results.detections[0]
-            bboxC = detection.location_data.relative_bounding_box
-            x = int(bboxC.xmin * width)
-            y = int(bboxC.ymin * height)
-            w = int(bboxC.width * width)
-            h = int(bboxC.height * height)
-
-            # Calculate the center of the face and define crop bounds
-            center_x = x + w // 2
-            left = max(center_x - output_resolution[0] // 2, 0)
-            right = min(center_x + output_resolution[0] // 2, frame.shape[1])
-
-            # Adjust bounds if necessary to fit the output resolution
-            if right - left < output_resolution[0]:
-                left = max(0, right - output_resolution[0])
-
-            # Crop and resize the frame
-            cropped_frame = frame[:, left:right]
-            resized_frame = cv2.resize(cropped_frame, output_resolution)
-
-            last_frame = resized_frame  # Store the last detected frame
-            return resized_frame
-
-        # Use the last known frame if no faces are detected
-        if last_frame is not None:
-            return last_frame
-        else:
-            # Return a black frame if no faces were detected initially
-            return np.zeros((output_resolution[1], output_resolution[0], 3), dtype=np.uint8)
-
-    # Apply the cropping function to each frame of the video
-    cropped_clip = clip.fl(crop_video_frame)
-
-    # Save the processed video to the output file
-    cropped_clip.write_videofile(output_video, fps=clip.fps)
-
-    # Release the MediaPipe resources
-    face_detection.close()
-
-fc = crop_and_rotate_video(
-    input_video="no_crop_1_Bb3EbDC5943922eE.mp4",
-    output_video="experiments/testing_crop_mediaPipe.mp4"
-)
\ No newline at end of file
+if __name__ == "__main__":
+    # Сравнение детекции на каждом полном кадре и разреженной детекции со сглаживанием
+    baseline = crop_and_rotate_video(
+        input_video="no_crop_1_Bb3EbDC5943922eE.mp4",
+        output_video="experiments/testing_crop_mediaPipe_every_frame.mp4",
+        detect_every=1,
+        detection_width=None,
+        smooth=False
+    )
+    sparse = crop_and_rotate_video(
+        input_video="no_crop_1_Bb3EbDC5943922eE.mp4",
+        output_video="experiments/testing_crop_mediaPipe.mp4"
+    )
+    print(f"Detector time speed-up: x{baseline['detector_seconds'] / max(sparse['detector_seconds'], 1e-9):.1f}")
+    print(f"Overall speed-up: x{baseline['seconds'] / sparse['seconds']:.1f}")
@@ -3,7 +3,7 @@ import json
 import os
 import io
 from datetime import timedelta
-from typing import List
+from typing import Callable, List
 
 from pydantic import BaseModel
 from openai import OpenAI
@@ -20,16 +20,22 @@ from settings import Source
 from image_analysis import ImageAnalysis
 from video_analysis import VideoAnalysis
 from subtitle_analysis import SubtitlesAnalysis
-from moviepy.editor import VideoFileClip
+from response_cache import ResponseCache, parse_completion
+from artifact_sink import ArtifactSink
+from checkpoints import CheckpointStore, data_hash, run_stage
+from clip_export import ClipExporter, safe_filename
+from highlight_selection import HighlightSelector
+from subtitle_store import SubtitleStore
 
 import yt_dlp
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import time
 
 load_dotenv()
 
-def format_analysis_text(concat_analysis, start_fragment: int = 1, n_fragments: int = 20):
-    analysis_template = """
+analysis_template = """
 Fragment {index}:
 {separator}
 Video: {video_start} --> {video_end}
@@ -49,39 +55,48 @@ Video: {video_start} --> {video_end}
 Subtitles:
 {subtitles}
 """
+
+def format_analysis_fragment(index: int, item: dict) -> str:
+    video = item["video_analysis"]
+    video_analysis_dict = video["analysis"]
+    subtitles = item["subtitles_analysis"]
     
-    separator = '=' * 40
+    if subtitles:
+        subtitles_text = "\n".join(
+            "{start} --> {end}; sub_number {n}: {text}".format(
+                start=sub['start_timecode'],
+                end=sub['end_timecode'],
+                text=sub['subtitle'],
+                n=sub["subtitle_number"]
+            ) for sub in subtitles
+        )
+    else:
+        subtitles_text = "No subtitles for this fragment."
     
-    analysis_fragments = []
-    for index, item in enumerate(concat_analysis[start_fragment - 1:start_fragment+n_fragments], start_fragment):
-        video = item["video_analysis"]
-        video_analysis_dict = video["analysis"]
-        subtitles = item["subtitles_analysis"]
-        
-        if subtitles:
-            subtitles_text = "\n".join(
-                "{start} --> {end}; sub_number {n}: {text}".format(
-                    start=sub['start_timecode'],
-                    end=sub['end_timecode'],
-                    text=sub['subtitle'],
-                    n=sub["subtitle_number"]
-                ) for sub in subtitles
-            )
-        else:
-            subtitles_text = "No subtitles for this fragment."
-        
-        fragment = analysis_template.format(
-            index=index,
-            separator=separator,
-            video_start=video['start_timecode'],
-            video_end=video['end_timecode'],
-            scene_and_main_characters=video_analysis_dict["scene_and_main_characters"],
-            what_is_happening=video_analysis_dict["what_is_happening"],
-            what_is_interesting=video_analysis_dict["what_is_interesting"],
-            is_interesting=video_analysis_dict["is_interesting"],
-            subtitles=subtitles_text
+    return analysis_template.format(
+        index=index,
+        separator='=' * 40,
+        video_start=video['start_timecode'],
+        video_end=video['end_timecode'],
+        scene_and_main_characters=video_analysis_dict["scene_and_main_characters"],
+        what_is_happening=video_analysis_dict["what_is_happening"],
+        what_is_interesting=video_analysis_dict["what_is_interesting"],
+        is_interesting=video_analysis_dict["is_interesting"],
+        subtitles=subtitles_text
+    )
+
+def format_analysis_text(concat_analysis, start_fragment: int = 1, n_fragments: int = 20):
+    selected = concat_analysis[start_fragment - 1:start_fragment+n_fragments]
+    if start_fragment - 1 + len(selected) < len(concat_analysis):
+        print(
+            f"[format_analysis_text] - Warning: only {len(selected)} of {len(concat_analysis)} windows fit into the prompt, "
+            f"the rest are dropped (use selection_token_budget for long videos)"
         )
-        analysis_fragments.append(fragment)
+
+    analysis_fragments = [
+        format_analysis_fragment(index, item)
+        for index, item in enumerate(selected, start_fragment)
+    ]
                 
     return "\n\n".join(analysis_fragments)
 
@@ -146,44 +161,103 @@ class VideoAnalysisBySubtitles():
 
 Выведи ответ в формате JSON.
 """
-    def __init__(self, video_interval: int = 10, resize_factor: int = 30):
+    def __init__(self, 
+            video_interval: int = 10, 
+            resize_factor: int = 30, 
+            max_in_flight: int = 4, 
+            cache_bypass: bool = False,
+            dedup_threshold: int = None,
+            adaptive_windows: bool = False,
+            context_windows: int = 3,
+            context_token_budget: int = 1500,
+            whisper_model: str = "tiny",
+            whisper_device: str = "cpu",
+            transcription_workers: int = None,
+            correction_confidence_threshold: float = None,
+            persist_artifacts: bool = True,
+            compact_json: bool = False,
+            clip_export_mode: str = "reencode",
+            clip_export_workers: int = 3, # Ассистенты выбирают три клипа
+            clip_export_threads: int = None, # По умолчанию ядра делятся между clip_export_workers
+            selection_token_budget: int = None,
+            vertical_clips: bool = False,
+            vertical_clip_size: tuple[int, int] = (720, 1280),
+            vertical_clip_workers: int = None
+        ):
+        # Общий кэш ответов LLM для анализа кадров, коррекции субтитров и ассистентов
+        self.cache = ResponseCache(bypass=cache_bypass)
         self.video_analysis = VideoAnalysis(
-            resize_factor=resize_factor
+            resize_factor=resize_factor,
+            cache=self.cache
+        )
+        self.max_in_flight = max_in_flight # Число одновременных запросов к LLM при анализе видео
+        self.dedup_threshold = dedup_threshold # Порог dHash для повторного использования анализа окна
+        self.adaptive_windows = adaptive_windows # Окна анализа видео по склейкам (ShotDetector)
+        self.context_windows = context_windows # Последних окон в контексте сцены при анализе видео
+        self.context_token_budget = context_token_budget # Бюджет токенов контекста сцены
+        self.subtitles_analysis = SubtitlesAnalysis(
+            cache=self.cache,
+            whisper_model=whisper_model,
+            whisper_device=whisper_device,
+            transcription_workers=transcription_workers,
+            correction_confidence_threshold=correction_confidence_threshold
         )
-        self.subtitles_analysis = SubtitlesAnalysis()
         self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        # Промежуточные JSON пишутся в фоне и не перечитываются; этапы обмениваются объектами
+        self.persist_artifacts = persist_artifacts
+        self.compact_json = compact_json
+        self.stage_timings = {} # Этап -> (начало, конец) в секундах от старта
+        # Если задано, первый ассистент видит все окна видео: они пакуются в запросы
+        # по selection_token_budget токенов (map), кандидаты ранжируются одним запросом (reduce)
+        self.selection_token_budget = selection_token_budget
+        # Если включено, для каждого фрагмента дополнительно рендерится вертикальный клип по лицу
+        # (vertical_clip_workers процессов, по умолчанию по числу ядер; потоки ffmpeg делятся между ними)
+        self.vertical_clips = vertical_clips
+        self.vertical_clip_size = vertical_clip_size
+        self.vertical_clip_workers = vertical_clip_workers
+        # "reencode" - полное перекодирование, "copy" - только копирование (начало сдвигается на ключевой кадр),
+        # "accurate" - перекодируется только начало клипа до ключевого кадра (только H.264, с проверкой результата)
+        # clip_export_workers клипов режутся одновременно, у каждого ffmpeg clip_export_threads потоков
+        self.clip_exporter = ClipExporter(
+            mode=clip_export_mode,
+            threads=clip_export_threads,
+            workers=clip_export_workers
+        )
 
-    def video_subtitles_concat(self, video_analysis_json: str, subtitles_json: str, output_json: str) -> None:
-        # Чтение JSON файлов с анализом видео и субтитрами
-        with open(video_analysis_json, 'r', encoding='utf-8') as va_file:
-            video_analysis = json.load(va_file)
+    def video_subtitles_concat(self, 
+            video_analysis: list[dict], 
+            subtitles_analysis: dict, 
+            output_json: str = None, 
+            sink: ArtifactSink = None,
+            subtitle_store: SubtitleStore = None
+        ) -> list[dict]:
+        combined_analysis = self.join_subtitles(video_analysis, subtitles_analysis["subtitles"], subtitle_store)
         
-        with open(subtitles_json, 'r', encoding='utf-8') as st_file:
-            subtitles_analysis = json.load(st_file)
-        
-        # Объединение анализов на основе частично совпадающих таймкодов
+        # Сохранение объединенного анализа в JSON файл
+        if sink is not None:
+            sink.write(output_json, combined_analysis)
+
+        return combined_analysis
+
+    @classmethod
+    def join_subtitles(cls, video_analysis: list[dict], subtitles: list[dict], subtitle_store: SubtitleStore = None) -> list[dict]:
+        """
+        Объединение анализов на основе частично совпадающих таймкодов.
+        Субтитр попадает в окно, если отрезки [start, end] пересекаются.
+        Кандидаты для окна ищутся через bisect по индексу времени SubtitleStore:
+        O((окна + субтитры) * log), а не окна * субтитры.
+        """
+        store = subtitle_store if subtitle_store is not None else SubtitleStore(subtitles)
+
         combined_analysis = []
         for va in video_analysis:
-            va_start = self.timecode_to_seconds(va["start_timecode"])
-            va_end = self.timecode_to_seconds(va["end_timecode"])
-            
-            matching_subtitles = []
-            for st in subtitles_analysis["subtitles"]:
-                st_start = st["start_timecode"]
-                st_end = st["end_timecode"]
-                
-                # Проверка на частичное совпадение таймкодов
-                if (va_start <= st_start <= va_end) or (va_start <= st_end <= va_end) or (st_start <= va_start <= st_end):
-                    matching_subtitles.append(st)
-            
             combined_analysis.append({
                 "video_analysis": va,
-                "subtitles_analysis": matching_subtitles
+                "subtitles_analysis": store.overlapping(
+                    cls.timecode_to_seconds(va["start_timecode"]),
+                    cls.timecode_to_seconds(va["end_timecode"])
+                )
             })
-        
-        # Сохранение объединенного анализа в JSON файл
-        with open(output_json, 'w', encoding='utf-8') as output_file:
-            json.dump(combined_analysis, output_file, ensure_ascii=False, indent=4)
 
         return combined_analysis
 
@@ -194,60 +268,226 @@ class VideoAnalysisBySubtitles():
         seconds, milliseconds = seconds.split(',')
         return int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(milliseconds) / 1000
 
-    def local_analysis(self, output_dir: str, video_path: str, cut_by_seconds: int = 300) -> None:
-        uuid = str(uuid4())
+    def run_stages(self, **stages: Callable[[], tuple]) -> dict:
+        """
+        Запускает независимые этапы одновременно и ждёт все (join перед конкатенацией).
+        Анализ кадров почти всё время ждёт ответа LLM, а Whisper занят CPU
+        (torch и декодирование отпускают GIL), поэтому этапы хорошо перекрываются.
+        Тайминги этапов сохраняются в self.stage_timings.
+        """
+        started = time.perf_counter()
+
+        def timed(name: str, stage: Callable[[], tuple]) -> tuple:
+            stage_start = time.perf_counter() - started
+            result = stage()
+            self.stage_timings[name] = (stage_start, time.perf_counter() - started)
+            return result
+
+        with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+            futures = {name: executor.submit(timed, name, stage) for name, stage in stages.items()}
+            results = {name: future.result() for name, future in futures.items()}
+
+        for name in stages:
+            stage_start, stage_end = self.stage_timings[name]
+            print(f"[VideoAnalysisBySubtitles] - [run_stages] - {name}: {stage_start:.1f}s -> {stage_end:.1f}s ({stage_end - stage_start:.1f}s)")
+        overlap = min(end for _, end in self.stage_timings.values()) - max(start for start, _ in self.stage_timings.values())
+        print(f"[VideoAnalysisBySubtitles] - [run_stages] - Wall time {time.perf_counter() - started:.1f}s, stages overlapped {max(0.0, overlap):.1f}s")
+
+        return results
+
+    def video_stage_params(self, source: str, cut_by_seconds: int) -> dict:
+        """
+        Все параметры, от которых зависит результат анализа кадров.
+        max_in_flight тоже: контекст сцены собирается только из уже завершённых окон.
+        """
+        return {
+            "source": source,
+            "interval_seconds": cut_by_seconds,
+            "resize_factor": self.video_analysis.resize_factor,
+            "black_and_white": self.video_analysis.image_analysis.black_and_white,
+            "frames_per_analysis": self.video_analysis.frames_per_analysis,
+            "max_in_flight": self.max_in_flight,
+            "context_windows": self.context_windows,
+            "context_token_budget": self.context_token_budget,
+            "dedup_threshold": self.dedup_threshold,
+            "adaptive_windows": self.adaptive_windows
+        }
+
+    def stage_cache(self, checkpoints: CheckpointStore, stage: str) -> ResponseCache:
+        """Кэш ответов LLM для этапа: пересчитываемый через force_stages этап не читает старые ответы."""
+        if checkpoints is not None and checkpoints.is_forced(stage):
+            return self.cache.refreshing()
+        return self.cache
+
+    def local_analysis(self, 
+            output_dir: str, 
+            video_path: str, 
+            cut_by_seconds: int = 300, 
+            sink: ArtifactSink = None, 
+            checkpoints: CheckpointStore = None
+        ) -> tuple:
+        uuid = checkpoints.run_id if checkpoints is not None else str(uuid4())
         os.makedirs(output_dir, exist_ok=True)
 
-        video_analysis, total_tokens_video = self.video_analysis.run(
-            source=Source.Local,
-            video_path=video_path,
-            output_json=f"{output_dir}/{uuid}-video.json",
-            interval_seconds=cut_by_seconds
-        )
-
-        subtitles_analysis, total_tokens_subtitles = self.subtitles_analysis.run(
-            source=Source.Local,
-            video_path=video_path,
-            output_json=f"{output_dir}/{uuid}-subtitles.json"
+        results = self.run_stages(
+            video=partial(
+                run_stage,
+                checkpoints,
+                "video_analysis",
+                self.video_stage_params(Source.Local, cut_by_seconds),
+                partial(
+                    self.video_analysis.run,
+                    source=Source.Local,
+                    video_path=video_path,
+                    output_json=f"{output_dir}/{uuid}-video.json",
+                    interval_seconds=cut_by_seconds,
+                    max_in_flight=self.max_in_flight,
+                    context_windows=self.context_windows,
+                    context_token_budget=self.context_token_budget,
+                    dedup_threshold=self.dedup_threshold,
+                    adaptive_windows=self.adaptive_windows,
+                    sink=sink
+                ),
+                tokens=lambda data: data[1]
+            ),
+            subtitles=partial(
+                self.subtitles_analysis.run,
+                source=Source.Local,
+                video_path=video_path,
+                output_json=f"{output_dir}/{uuid}-subtitles.json",
+                sink=sink,
+                checkpoints=checkpoints
+            )
         )
+        video_analysis, total_tokens_video = results["video"]
+        subtitles_analysis, total_tokens_subtitles = results["subtitles"]
 
-        return uuid, total_tokens_video + total_tokens_subtitles
+        return uuid, video_analysis, subtitles_analysis, total_tokens_video + total_tokens_subtitles
 
-    def youtube_analysis(self, output_dir: str, youtube_video_url: str, cut_by_seconds: int = 300) -> None:
-        uuid = str(uuid4())
+    def youtube_analysis(self, 
+            output_dir: str, 
+            youtube_video_url: str, 
+            cut_by_seconds: int = 300, 
+            sink: ArtifactSink = None, 
+            checkpoints: CheckpointStore = None
+        ) -> tuple:
+        uuid = checkpoints.run_id if checkpoints is not None else str(uuid4())
         os.makedirs(output_dir, exist_ok=True)
 
-        video_analysis, total_tokens_video = self.video_analysis.run(
-            output_json=f"{output_dir}/{uuid}-video.json",
-            source=Source.Youtube,
-            youtube_video_url=youtube_video_url,
-            interval_seconds=cut_by_seconds
-        )
-
-        subtitles_analysis, total_tokens_subtitles = self.subtitles_analysis.run(
-            output_json=f"{output_dir}/{uuid}-subtitles.json",
-            source=Source.Youtube,
-            youtube_video_url=youtube_video_url
+        results = self.run_stages(
+            video=partial(
+                run_stage,
+                checkpoints,
+                "video_analysis",
+                self.video_stage_params(Source.Youtube, cut_by_seconds),
+                partial(
+                    self.video_analysis.run,
+                    output_json=f"{output_dir}/{uuid}-video.json",
+                    source=Source.Youtube,
+                    youtube_video_url=youtube_video_url,
+                    interval_seconds=cut_by_seconds,
+                    max_in_flight=self.max_in_flight,
+                    context_windows=self.context_windows,
+                    context_token_budget=self.context_token_budget,
+                    dedup_threshold=self.dedup_threshold,
+                    adaptive_windows=self.adaptive_windows,
+                    sink=sink
+                ),
+                tokens=lambda data: data[1]
+            ),
+            subtitles=partial(
+                self.subtitles_analysis.run,
+                output_json=f"{output_dir}/{uuid}-subtitles.json",
+                source=Source.Youtube,
+                youtube_video_url=youtube_video_url,
+                sink=sink,
+                checkpoints=checkpoints
+            )
         )
+        video_analysis, total_tokens_video = results["video"]
+        subtitles_analysis, total_tokens_subtitles = results["subtitles"]
 
-        return uuid, total_tokens_video + total_tokens_subtitles
+        return uuid, video_analysis, subtitles_analysis, total_tokens_video + total_tokens_subtitles
     
 
-    def crop_video(self, video_path: str, start_timecode: float, end_timecode: float, output_path: str) -> None:
+    def plan_clips(self, 
+            fragments: list[dict], 
+            output_dir: str, 
+            uuid: str, 
+            subtitle_store: SubtitleStore = None,
+            suffix: str = "",
+            margin_seconds: float = 2.0
+        ) -> list[tuple[float, float, str]]:
+        """
+        (начало, конец, путь) для каждого фрагмента; одинаковые заголовки получают суффикс с номером.
+        Если передан subtitle_store, клип расширяется, чтобы покрыть used_subtitles
+        (без оторванных от остальных номеров), но не больше чем на margin_seconds
+        за таймкоды самого фрагмента.
+        """
+        clips = []
+        used_names = set()
+        for index, fragment in enumerate(fragments, 1):
+            name = safe_filename(fragment['title'])
+            if name in used_names:
+                name = f"{name}_{index}"
+            used_names.add(name)
+
+            start, end = fragment['start_timecode'], fragment['end_timecode']
+            span = subtitle_store.span(fragment['used_subtitles']) if subtitle_store is not None else None
+            if span is not None:
+                start = max(min(start, span[0]), start - margin_seconds)
+                end = min(max(end, span[1]), end + margin_seconds)
+            clips.append((start, end, f"{output_dir}/{uuid}-{name}{suffix}.mp4"))
+
+        return clips
+
+    def crop_fragments(self, 
+            video_path: str, 
+            fragments: list[dict], 
+            output_dir: str, 
+            uuid: str, 
+            subtitle_store: SubtitleStore = None
+        ) -> list[str]:
+        """Режет все фрагменты одним заданием."""
+        clips = self.plan_clips(fragments, output_dir, uuid, subtitle_store)
+
         try:
-            video = VideoFileClip(video_path)
-            cropped_video = video.subclip(start_timecode, end_timecode)
-            cropped_video.write_videofile(output_path)
-            
-            video.close()
-            cropped_video.close()
-            
-            print(f"Video cropped successfully: {output_path}")
+            self.clip_exporter.export_many(video_path, clips)
+            print(f"Videos cropped successfully: {len(clips)} clips")
         except Exception as e:
             print(f"An error occurred while cropping video: {str(e)}")
-        
-    def ai_analyzer(self, text: str, prompt: str, response_format: BaseModel) -> tuple[list[dict], int, int, int]:
-        completion = self.client.beta.chat.completions.parse(
+
+        return [output_path for _, _, output_path in clips]
+
+    def vertical_clip_fragments(self, 
+            video_path: str, 
+            fragments: list[dict], 
+            output_dir: str, 
+            uuid: str, 
+            subtitle_store: SubtitleStore = None
+        ) -> list[str]:
+        """
+        Вертикальные (9:16) клипы прямо из исходного видео, в пуле процессов: горизонтальный кадр
+        не поворачивается, из него вырезается столбец 9:16 вокруг лица.
+        Возвращает пути только успешно отрендеренных клипов.
+        """
+        from face_cropping import render_vertical_clips # MediaPipe нужен только для этого этапа
+
+        clips = self.plan_clips(fragments, output_dir, uuid, subtitle_store, suffix="-vertical")
+
+        try:
+            render_vertical_clips(video_path, clips, size=self.vertical_clip_size, workers=self.vertical_clip_workers)
+            print(f"Vertical videos rendered successfully: {len(clips)} clips")
+        except Exception as e:
+            print(f"An error occurred while rendering vertical video: {str(e)}")
+
+        # Неудавшиеся клипы удаляются в render_vertical_clips
+        return [output_path for _, _, output_path in clips if os.path.exists(output_path)]
+
+    def ai_analyzer(self, text: str, prompt: str, response_format: BaseModel, cache: ResponseCache = None) -> tuple[list[dict], int, int, int]:
+        content, usage = parse_completion(
+            self.client,
+            cache if cache is not None else self.cache,
             model="gpt-4o-2024-08-06",
 
             messages=[
@@ -264,18 +504,58 @@ class VideoAnalysisBySubtitles():
         )
 
         return (
-            json.loads(completion.choices[0].message.content), 
-            completion.usage.completion_tokens, 
-            completion.usage.prompt_tokens, 
-            completion.usage.total_tokens
+            json.loads(content), 
+            usage["completion_tokens"], 
+            usage["prompt_tokens"], 
+            usage["total_tokens"]
         )
     
+    def format_assistant_fragments(self, fragments: list[dict], subtitle_store: SubtitleStore) -> str:
+        parts = []
+        for item in fragments:
+            parts.append(
+                f"Fragment {item['title']}:\n"
+                f"Start: {item['start_timecode']}\n"
+                f"End: {item['end_timecode']}\n"
+                f"Текст фрагмента: {subtitle_store.text(item['used_subtitles'])}\n"
+                f"Субтитры использованные: {', '.join(map(str, item['used_subtitles']))}\n"
+                + 40 * "=" + "\n\n"
+            )
+
+        return "".join(parts)
+
+    def windows_for_fragments(self, concat_analysis: list[dict], fragments: list[dict]) -> list[dict]:
+        """Окна анализа, пересекающиеся хотя бы с одним из фрагментов."""
+        return [
+            item for item in concat_analysis
+            if any(
+                self.timecode_to_seconds(item["video_analysis"]["start_timecode"]) <= fragment["end_timecode"]
+                and self.timecode_to_seconds(item["video_analysis"]["end_timecode"]) >= fragment["start_timecode"]
+                for fragment in fragments
+            )
+        ]
+
     def first_assistant_analyze(self, 
             concat_analysis: list[dict], 
             client_wants: str,
-            output_dir: str
+            output_dir: str,
+            subtitle_store: SubtitleStore = None,
+            cache: ResponseCache = None
         ) -> tuple[list[dict], int, int, int]:
         # Анализ первым ассистентом
+        if self.selection_token_budget is not None:
+            selector = HighlightSelector(
+                analyze=partial(self.ai_analyzer, cache=cache),
+                response_format=InterestingMoments,
+                token_budget=self.selection_token_budget,
+                max_in_flight=self.max_in_flight
+            )
+            return selector.run(
+                fragment_texts=[format_analysis_fragment(index, item) for index, item in enumerate(concat_analysis, 1)],
+                client_wants=client_wants,
+                describe_candidates=partial(self.format_assistant_fragments, subtitle_store=subtitle_store or SubtitleStore([]))
+            )
+
         analysis_text = format_analysis_text(concat_analysis)
         analysis_text_assistant = ""
         first_assistant_prompt = self.redact_prompt.format(
@@ -288,7 +568,8 @@ class VideoAnalysisBySubtitles():
         analysis, completion_tokens, prompt_tokens, total_tokens_analysis_1 = self.ai_analyzer(
             text=first_assistant_prompt,
             prompt=self.analysis_prompt_1,
-            response_format=InterestingMoments
+            response_format=InterestingMoments,
+            cache=cache
         )
 
         return analysis, completion_tokens, prompt_tokens, total_tokens_analysis_1
@@ -298,23 +579,19 @@ class VideoAnalysisBySubtitles():
             client_wants: str,
             output_dir: str,
             subtitles: list[dict],
-            assistant_analysis: list[dict]
+            assistant_analysis: list[dict],
+            subtitle_store: SubtitleStore = None,
+            cache: ResponseCache = None
         ) -> tuple[list[dict], int, int, int]:
         # Анализ вторым ассистентом
+        if subtitle_store is None:
+            subtitle_store = SubtitleStore(subtitles)
+        if self.selection_token_budget is not None:
+            # Для длинных видео - только окна вокруг выбранных клипов
+            concat_analysis = self.windows_for_fragments(concat_analysis, assistant_analysis['fragments'])
         analysis_text = format_analysis_text(concat_analysis)
         analysis_text_assistant = "Вот клипы, которые создал первый ассистент:\n"
-        for item in assistant_analysis['fragments']:
-            used_subtitles = item['used_subtitles']
-            subs = ""
-            for num in used_subtitles:
-                subs += " ".join([j['subtitle'] for j in subtitles if j['subtitle_number'] == num])
-
-            analysis_text_assistant += f"Fragment {item['title']}:\n"
-            analysis_text_assistant += f"Start: {item['start_timecode']}\n"
-            analysis_text_assistant += f"End: {item['end_timecode']}\n"
-            analysis_text_assistant += f"Текст фрагмента: {subs}\n"
-            analysis_text_assistant += f"Субтитры использованные: {', '.join(list(map(lambda x: str(x), item['used_subtitles'])))}\n"
-            analysis_text_assistant += 40 * "=" + "\n\n"
+        analysis_text_assistant += self.format_assistant_fragments(assistant_analysis['fragments'], subtitle_store)
 
         # for testing purposes
         second_assistant_prompt = self.redact_prompt.format(
@@ -327,7 +604,8 @@ class VideoAnalysisBySubtitles():
         analysis, completion_tokens, prompt_tokens, total_tokens_analysis_2 = self.ai_analyzer(
             text=second_assistant_prompt,
             prompt=self.analysis_prompt_2,
-            response_format=InterestingMoments
+            response_format=InterestingMoments,
+            cache=cache
         )
 
         return analysis, completion_tokens, prompt_tokens, total_tokens_analysis_2
@@ -338,75 +616,150 @@ class VideoAnalysisBySubtitles():
             video_path: str = None, 
             youtube_video_url: str = None,
             client_wants: str = "",
-            cut_by_seconds: int = 300 # 5 minutes
+            cut_by_seconds: int = 300, # 5 minutes
+            force_stages: list[str] = ()
         ) -> None:
+        """
+        Этапы сохраняются в {output_dir}/checkpoints под ключом из хэша входного видео
+        и параметров этапа; повторный запуск пропускает готовые этапы.
+        force_stages - этапы, которые нужно пересчитать (см. checkpoints.STAGES),
+        вместе с ними пересчитываются и все зависящие от них. Этапы с LLM при этом
+        не берут ответы из кэша, а перезаписывают их.
+        Итоговый JSON и клипы именуются по входу и client_wants, поэтому запуски
+        с разными пожеланиями к одному видео не перезаписывают друг друга.
+        Возвращает (анализ, токены, потраченные в этом запуске, время);
+        токены этапов из чекпоинтов печатаются отдельно.
+        """
 
         start_time = time.time()
-
-        if source == Source.Local:
-            uuid, total_tokens_video = self.local_analysis(output_dir, video_path, cut_by_seconds)
-        elif source == Source.Youtube:
-            uuid, total_tokens_video = self.youtube_analysis(output_dir, youtube_video_url, cut_by_seconds)
-        else:
-            raise ValueError(f"Invalid source: {source}")
-            
-        output_json_video = f"{output_dir}/{uuid}-video.json"
-        output_json_subtitles = f"{output_dir}/{uuid}-subtitles.json"
-        output_json_concat = f"{output_dir}/{uuid}-concat.json"
-        output_json_interesting_moments = f"{output_dir}/{uuid}-interesting_moments.json"
-
-        # Конкантенация субтитров с видео
-        analysis = self.video_subtitles_concat(
-            video_analysis_json=f"{output_dir}/{uuid}-video.json",
-            subtitles_json=f"{output_dir}/{uuid}-subtitles.json",
-            output_json=f"{output_dir}/{uuid}-concat.json"
+        checkpoints = CheckpointStore.for_input(
+            f"{output_dir}/checkpoints",
+            video_path=video_path if source == Source.Local else None,
+            youtube_video_url=youtube_video_url,
+            force_stages=force_stages
         )
-        concat_analysis = json.load(open(output_json_concat, 'r', encoding='utf-8'))
-        subtitles = json.load(open(output_json_subtitles, 'r', encoding='utf-8'))['subtitles']
+        self.video_analysis.image_analysis.cache = self.stage_cache(checkpoints, "video_analysis")
+        self.subtitles_analysis.cache = self.stage_cache(checkpoints, "correction")
+
+        # Промежуточные артефакты; при исключении уже начатые записи всё равно дописываются
+        with ArtifactSink(compact=self.compact_json, enabled=self.persist_artifacts) as sink:
+            if source == Source.Local:
+                uuid, video_analysis, subtitles_analysis, total_tokens_video = self.local_analysis(
+                    output_dir, video_path, cut_by_seconds, sink, checkpoints
+                )
+            elif source == Source.Youtube:
+                uuid, video_analysis, subtitles_analysis, total_tokens_video = self.youtube_analysis(
+                    output_dir, youtube_video_url, cut_by_seconds, sink, checkpoints
+                )
+            else:
+                raise ValueError(f"Invalid source: {source}")
+            
+            output_json_concat = f"{output_dir}/{uuid}-concat.json"
+            # Результаты ассистентов зависят от client_wants
+            request_id = f"{uuid}-{data_hash(client_wants)[:8]}"
+            output_json_interesting_moments = f"{output_dir}/{request_id}-interesting_moments.json"
+
+            subtitles = subtitles_analysis['subtitles']
+            # Общий индекс субтитров по номеру и времени для конкатенации, ассистентов и нарезки
+            subtitle_store = SubtitleStore(subtitles)
+            subtitles_hash = data_hash(subtitles_analysis)
+
+            # Конкантенация субтитров с видео
+            concat_analysis = checkpoints.cached(
+                "concat",
+                {"video": data_hash(video_analysis), "subtitles": subtitles_hash},
+                partial(
+                    self.video_subtitles_concat,
+                    video_analysis=video_analysis,
+                    subtitles_analysis=subtitles_analysis,
+                    output_json=output_json_concat,
+                    sink=sink,
+                    subtitle_store=subtitle_store
+                )
+            )
 
-        analysis, completion_tokens, prompt_tokens, total_tokens_analysis_1 = self.first_assistant_analyze(
-            concat_analysis=concat_analysis,
-            client_wants=client_wants,
-            output_dir=output_dir
-        )
+            assistant_params = {
+                "concat": data_hash(concat_analysis),
+                "client_wants": client_wants,
+                "selection_token_budget": self.selection_token_budget
+            }
+            analysis, completion_tokens, prompt_tokens, total_tokens_analysis_1 = checkpoints.cached(
+                "assistant_1",
+                assistant_params,
+                partial(
+                    self.first_assistant_analyze,
+                    concat_analysis=concat_analysis,
+                    client_wants=client_wants,
+                    output_dir=output_dir,
+                    subtitle_store=subtitle_store,
+                    cache=self.stage_cache(checkpoints, "assistant_1")
+                ),
+                tokens=lambda data: data[3]
+            )
 
-        analysis, completion_tokens, prompt_tokens, total_tokens_analysis_2 = self.second_assistant_analyze(
-            concat_analysis=concat_analysis,
-            client_wants=client_wants,
-            output_dir=output_dir,
-            subtitles=subtitles,
-            assistant_analysis=analysis
-        )
+            analysis, completion_tokens, prompt_tokens, total_tokens_analysis_2 = checkpoints.cached(
+                "assistant_2",
+                {**assistant_params, "assistant_1": data_hash(analysis)},
+                partial(
+                    self.second_assistant_analyze,
+                    concat_analysis=concat_analysis,
+                    client_wants=client_wants,
+                    output_dir=output_dir,
+                    subtitles=subtitles,
+                    assistant_analysis=analysis,
+                    subtitle_store=subtitle_store,
+                    cache=self.stage_cache(checkpoints, "assistant_2")
+                ),
+                tokens=lambda data: data[3]
+            )
 
-        # Кроп видео
-        for fragment in analysis['fragments']:
-            self.crop_video(
-                video_path=video_path,
-                start_timecode=fragment['start_timecode'],
-                end_timecode=fragment['end_timecode'],
-                output_path=f"{output_dir}/{uuid}-{fragment['title']}.mp4"
+            # Кроп видео
+            checkpoints.cached(
+                "crops",
+                {"fragments": data_hash(analysis['fragments']), "subtitles": subtitles_hash, "export_mode": self.clip_exporter.mode,
+                 "output_prefix": request_id},
+                partial(self.crop_fragments, video_path, analysis['fragments'], output_dir, request_id, subtitle_store),
+                validate=lambda paths: all(os.path.exists(path) for path in paths)
             )
 
-        # Сохранение результатов анализа
-        with open(output_json_interesting_moments, 'w', encoding='utf-8') as output_file:
-            json.dump(analysis, output_file, ensure_ascii=False, indent=4)
+            if self.vertical_clips and source == Source.Local:
+                checkpoints.cached(
+                    "vertical_clips",
+                    {"fragments": data_hash(analysis['fragments']), "subtitles": subtitles_hash, "size": list(self.vertical_clip_size),
+                     "output_prefix": request_id, "layout": "face_column"},
+                    partial(self.vertical_clip_fragments, video_path, analysis['fragments'], output_dir, request_id, subtitle_store),
+                    # Чекпоинт с неудавшимися клипами не принимается, этап повторится при следующем запуске
+                    validate=lambda paths: len(paths) == len(analysis['fragments']) and all(os.path.exists(path) for path in paths)
+                )
+
+        # Итоговый результат пишется всегда, даже с persist_artifacts=False
+        with open(output_json_interesting_moments, 'w', encoding='utf-8') as json_file:
+            json.dump(analysis, json_file, ensure_ascii=False, indent=4)
+
+        print(f"[VideoAnalysisBySubtitles] - [run] - Response cache stats: {self.cache.stats()}")
+        print(f"[VideoAnalysisBySubtitles] - [run] - Stages reused from checkpoints: {checkpoints.reused}")
+        reused_tokens = sum(checkpoints.reused_tokens.values())
+        print(f"[VideoAnalysisBySubtitles] - [run] - Tokens reused from checkpoints (not spent in this run): "
+              f"{reused_tokens} {checkpoints.reused_tokens}")
+        print(f"[VideoAnalysisBySubtitles] - [run] - Clip export stats: {self.clip_exporter.stats()}")
 
         time_consumed = time.time() - start_time
         return (
             analysis, 
-            total_tokens_video + total_tokens_analysis_1 + total_tokens_analysis_2,
+            total_tokens_video + total_tokens_analysis_1 + total_tokens_analysis_2 - reused_tokens,
             time_consumed
         )
 
 
-vabs = VideoAnalysisBySubtitles(
-    video_interval=60,
-)
+if __name__ == "__main__":
+    vabs = VideoAnalysisBySubtitles(
+        video_interval=60,
+    )
 
-print(vabs.run(
-    output_dir='output_files_example4',
-    source=Source.Local,
-    video_path='input_files/example3.mp4',
-    client_wants="Сделай клипы где Никита рассказывает о своей жизни после того, как его сбил комбайн.",
-))
+    print(vabs.run(
+        output_dir='output_files_example4',
+        source=Source.Local,
+        video_path='input_files/example3.mp4',
+        client_wants="Сделай клипы где Никита рассказывает о своей жизни после того, как его сбил комбайн.",
+    ))
 
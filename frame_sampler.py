@@ -0,0 +1,87 @@
+import time
+from typing import Iterator, List, Tuple
+
+import cv2
+import numpy as np
+
+
+class FrameSampler():
+    """
+    Выборка кадров из видео по возрастающим номерам.
+    Небольшие промежутки проходятся по порядку (grab без конвертации в изображение),
+    и каждый кадр декодируется не больше одного раза.
+    Если до следующего кадра больше seek_threshold кадров (по умолчанию 500 -
+    два интервала ключевых кадров x264 по умолчанию), выгоднее перейти
+    через cap.set(CAP_PROP_POS_FRAMES): декодируется только GOP до нужного кадра,
+    а не весь промежуток. seek_threshold=None - только последовательное чтение.
+    """
+    def __init__(self, cap: cv2.VideoCapture, seek_threshold: int = 500):
+        self.cap = cap
+        self.seek_threshold = seek_threshold
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        self.total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        self.position = 0  # Номер следующего кадра, который будет декодирован
+        self.frames_decoded = 0
+        self.seeks = 0
+        self.decode_seconds = 0.0
+        self._last = None  # (frame_position, pts_seconds, frame)
+
+    def _advance(self) -> bool:
+        """Декодирует следующий кадр без конвертации в изображение."""
+        ok = self.cap.grab()
+        if ok:
+            self.position += 1
+            self.frames_decoded += 1
+        return ok
+
+    def read_at(self, frame_positions: List[int]) -> Iterator[Tuple[int, float, np.ndarray]]:
+        """
+        Возвращает кадры по неубывающим номерам frame_positions.
+        Для каждого кадра отдаёт (номер кадра, точный PTS в секундах, BGR кадр).
+        Останавливается на конце видео.
+        """
+        for target in frame_positions:
+            if self._last is not None and target <= self._last[0]:
+                # Повторный запрос того же кадра (frame_step == 0) - назад не ходим
+                yield self._last
+                continue
+
+            started = time.perf_counter()
+            if self.seek_threshold is not None and target - self.position > self.seek_threshold:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+                self.position = target
+                self.seeks += 1
+
+            while self.position < target:
+                if not self._advance():
+                    self.decode_seconds += time.perf_counter() - started
+                    return
+
+            if not self._advance():
+                self.decode_seconds += time.perf_counter() - started
+                return
+
+            ok, frame = self.cap.retrieve()
+            self.decode_seconds += time.perf_counter() - started
+            if not ok:
+                return
+
+            # После grab() позиция в мс соответствует только что декодированному кадру
+            pts = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            self._last = (target, pts, frame)
+            yield self._last
+
+    @property
+    def decode_fps(self) -> float:
+        if self.decode_seconds == 0:
+            return 0.0
+        return self.frames_decoded / self.decode_seconds
+
+    def stats(self) -> dict:
+        return {
+            "frames_decoded": self.frames_decoded, # Без кадров, декодированных внутри seek
+            "seeks": self.seeks,
+            "decode_seconds": round(self.decode_seconds, 3),
+            "decode_fps": round(self.decode_fps, 1)
+        }
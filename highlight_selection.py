@@ -0,0 +1,156 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from pydantic import BaseModel
+
+from scene_context import count_tokens
+
+
+class HighlightSelector():
+    """
+    Выбор клипов для длинных видео в два этапа (map-reduce).
+    map: окна анализа упаковываются в пачки не длиннее token_budget токенов,
+    в каждой пачке независимо (до max_in_flight запросов одновременно)
+    выбираются кандидаты в клипы.
+    reduce: один запрос ранжирует общий список кандидатов и выбирает итоговые клипы.
+    Так модель видит все окна видео, а не только первые.
+    analyze - функция (text, prompt, response_format) -> (analysis, completion, prompt, total),
+    обычно VideoAnalysisBySubtitles.ai_analyzer.
+    """
+    map_prompt = """
+Ты - редактор видео, который анализирует видео и субтитры и ищет кандидатов в популярные клипы.
+Тебе дана только часть видео. Выбери в ней до {candidates} самых интересных фрагментов.
+Если в этой части нет ничего интересного, верни пустой список.
+
+При выборе фрагмента следуй правилам:
+1. Аккуратно обращайся с таймкодами, они должны быть МАКСИМАЛЬНО ТОЧНЫМИ.
+2. Ты можешь выбирать таймкоды только по субтитрам.
+3. Итоговый фрагмент не должен быть длиннее 1 минуты и не менее 30 секунд.
+4. Таймкоды фрагментов должны включать полные предложения.
+
+Дай каждому клипу небольшой уникальный заголовок не длиннее 3 слов.
+Укажи номера субтитров, которые использовал
+
+Выведи ответ в формате JSON.
+    """
+
+    reduce_prompt = """
+Ты - редактор видео, который создаёт популярные клипы.
+Тебе даны кандидаты в клипы, выбранные из разных частей видео.
+Выбери из них ТРИ самых интересных клипа с учётом пожеланий клиента.
+Не меняй таймкоды и номера субтитров кандидатов.
+
+Выведи ответ в формате JSON.
+    """
+
+    batch_template = """
+Придерживайся пожеланий клиента к интересным фрагментам:
+{client_wants}
+
+Вот информация о части видео:
+{video_analysis}
+"""
+
+    shortlist_template = """
+Придерживайся пожеланий клиента к интересным фрагментам:
+{client_wants}
+
+Вот кандидаты в клипы:
+{candidates}
+"""
+
+    def __init__(self,
+            analyze: Callable[[str, str, BaseModel], tuple],
+            response_format: BaseModel,
+            token_budget: int = 6000,
+            max_in_flight: int = 4,
+            candidates_per_batch: int = 3
+        ):
+        self.analyze = analyze
+        self.response_format = response_format
+        self.token_budget = token_budget
+        self.max_in_flight = max_in_flight
+        self.candidates_per_batch = candidates_per_batch
+        self.phase_stats = {}
+
+    def pack(self, fragment_texts: List[str], client_wants: str = "") -> List[str]:
+        """
+        Склеивает тексты окон в пачки так, чтобы весь запрос (системный промпт,
+        шаблон с client_wants и окна) был не длиннее token_budget.
+        Окно длиннее бюджета идёт отдельной пачкой.
+        """
+        overhead = count_tokens(
+            self.map_prompt.format(candidates=self.candidates_per_batch)
+            + self.batch_template.format(client_wants=client_wants, video_analysis="")
+        )
+        budget = self.token_budget - overhead
+        separator_tokens = count_tokens("\n\n")
+        batches, current, current_tokens = [], [], 0
+        for text in fragment_texts:
+            tokens = count_tokens(text)
+            if current and current_tokens + separator_tokens + tokens > budget:
+                batches.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current_tokens += tokens + (separator_tokens if current else 0)
+            current.append(text)
+        if current:
+            batches.append("\n\n".join(current))
+        return batches
+
+    def _record(self, phase: str, started: float, results: list) -> None:
+        self.phase_stats[phase] = {
+            "calls": len(results),
+            "completion_tokens": sum(result[1] for result in results),
+            "prompt_tokens": sum(result[2] for result in results),
+            "total_tokens": sum(result[3] for result in results),
+            "seconds": round(time.perf_counter() - started, 2)
+        }
+        print(f"[HighlightSelector] - [{phase}] - {self.phase_stats[phase]}")
+
+    def map(self, fragment_texts: List[str], client_wants: str) -> List[dict]:
+        """Кандидаты в клипы из всех пачек, в порядке пачек."""
+        started = time.perf_counter()
+        prompt = self.map_prompt.format(candidates=self.candidates_per_batch)
+        texts = [
+            self.batch_template.format(client_wants=client_wants, video_analysis=batch)
+            for batch in self.pack(fragment_texts, client_wants)
+        ]
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            results = list(executor.map(lambda text: self.analyze(text, prompt, self.response_format), texts))
+
+        self._record("map", started, results)
+        return [fragment for result in results for fragment in result[0]["fragments"]]
+
+    def reduce(self, candidates_text: str, client_wants: str) -> tuple:
+        started = time.perf_counter()
+        result = self.analyze(
+            self.shortlist_template.format(client_wants=client_wants, candidates=candidates_text),
+            self.reduce_prompt,
+            self.response_format
+        )
+        self._record("reduce", started, [result])
+        return result
+
+    def run(self,
+            fragment_texts: List[str],
+            client_wants: str,
+            describe_candidates: Callable[[List[dict]], str]
+        ) -> tuple[dict, int, int, int]:
+        """
+        Возвращает результат reduce в формате ai_analyzer с суммой токенов обоих этапов.
+        describe_candidates - текст списка кандидатов для reduce (таймкоды и текст субтитров).
+        """
+        candidates = self.map(fragment_texts, client_wants)
+        map_stats = self.phase_stats["map"]
+        if not candidates:
+            return {"fragments": []}, map_stats["completion_tokens"], map_stats["prompt_tokens"], map_stats["total_tokens"]
+
+        analysis, completion_tokens, prompt_tokens, total_tokens = self.reduce(describe_candidates(candidates), client_wants)
+        return (
+            analysis,
+            completion_tokens + map_stats["completion_tokens"],
+            prompt_tokens + map_stats["prompt_tokens"],
+            total_tokens + map_stats["total_tokens"]
+        )
@@ -11,6 +11,8 @@ load_dotenv()
 from pydantic import BaseModel
 from pprint import pprint
 
+from response_cache import ResponseCache, parse_completion
+
 class ImageAnalysisModel(BaseModel):
     scene_and_main_characters: str
     what_is_happening: str
@@ -72,9 +74,10 @@ class ImageAnalysis():
 ТЫ ОБЯЗАН ВЫБРАТЬ ОДИН ВРЕМЕННЫЙ ОТРЕЗОК, КОТОРЫЙ БУДЕТ САМЫМ ИНТЕРЕСНЫМ
     """
 
-    def __init__(self, api_key: str = None, resize_factor: int = 10, black_and_white: bool = False):
+    def __init__(self, api_key: str = None, resize_factor: int = 10, black_and_white: bool = False, cache: ResponseCache = None):
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         self.client = OpenAI(api_key=self.api_key)
+        self.cache = cache
         self.resize_factor = resize_factor
         self.black_and_white = black_and_white
 
@@ -87,6 +90,9 @@ class ImageAnalysis():
         Этот параметр нужен для уменьшения затрат на обработку изображения.
         """
 
+        if self.resize_factor == 1:
+            return image
+
         width, height = image.size
         new_size = (width // self.resize_factor, height // self.resize_factor)
         new_image = image.resize(new_size, Image.LANCZOS)
@@ -111,7 +117,9 @@ class ImageAnalysis():
 
         base64_image = self.encode_image(resized_image)
 
-        response = self.client.beta.chat.completions.parse(
+        content, usage = parse_completion(
+            self.client,
+            self.cache,
             model="gpt-4o-2024-08-06",
             messages=[
                 {
@@ -140,9 +148,9 @@ class ImageAnalysis():
             response_format=ImageAnalysisModel
         )
 
-        completion_tokens = response.usage.completion_tokens
-        prompt_tokens = response.usage.prompt_tokens
-        total_tokens = response.usage.total_tokens
+        completion_tokens = usage["completion_tokens"]
+        prompt_tokens = usage["prompt_tokens"]
+        total_tokens = usage["total_tokens"]
 
-        return json.loads(response.choices[0].message.content), total_tokens
+        return json.loads(content), total_tokens
     
\ No newline at end of file
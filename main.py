@@ -1,22 +1,48 @@
 from final_analysis import VideoAnalysisBySubtitles
+from checkpoints import STAGES
 
 from settings import Source
 
 from pprint import pprint
+import argparse
 
 
-analyzer = VideoAnalysisBySubtitles(
-    video_interval=240, # Кадр берётся каждые 10 секунд
-    resize_factor=4 # Уменьшение размерности в 4 раза
-)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--force-stage",
+        action="append",
+        default=[],
+        choices=STAGES,
+        help="Пересчитать этап, даже если для него есть чекпоинт (можно указать несколько раз)"
+    )
+    parser.add_argument(
+        "--vertical-clips",
+        action="store_true",
+        help="Дополнительно сделать вертикальные (9:16) клипы с кадрированием по лицу"
+    )
+    parser.add_argument(
+        "--adaptive-windows",
+        action="store_true",
+        help="Нарезать окна анализа видео по склейкам, а не с фиксированным шагом"
+    )
+    args = parser.parse_args()
 
-# TODO: Fix weird bug with subtitles
-# TODO: Make LLM follow client_wants more strictly < weird bug
-# TODO: Make cut_every_seconds working
+    analyzer = VideoAnalysisBySubtitles(
+        video_interval=240, # Кадр берётся каждые 10 секунд
+        resize_factor=4, # Уменьшение размерности в 4 раза
+        adaptive_windows=args.adaptive_windows,
+        vertical_clips=args.vertical_clips
+    )
 
-pprint(analyzer.run(
-    output_dir='pitch_2_output',
-    source=Source.Local,
-    video_path='input_files/pitch_1.mp4',
-    client_wants="Сделай интересные видео из фрагмента где говорится про API и где ответы на вопросы, но лучше про вопросы. Каждое видео должно быть не меньше 30 секунд."
-))
\ No newline at end of file
+    # TODO: Fix weird bug with subtitles
+    # TODO: Make LLM follow client_wants more strictly < weird bug
+    # TODO: Make cut_every_seconds working
+
+    pprint(analyzer.run(
+        output_dir='pitch_2_output',
+        source=Source.Local,
+        video_path='input_files/pitch_1.mp4',
+        client_wants="Сделай интересные видео из фрагмента где говорится про API и где ответы на вопросы, но лучше про вопросы. Каждое видео должно быть не меньше 30 секунд.",
+        force_stages=args.force_stage
+    ))
\ No newline at end of file
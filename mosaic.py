@@ -0,0 +1,43 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+
+class MosaicBuilder():
+    """
+    Сборка сетки кадров (contact sheet) сразу в итоговом разрешении.
+    Каждый кадр уменьшается при декодировании и записывается
+    в заранее выделенный буфер, поэтому полноразмерная сетка
+    (frame_width * 4 x frame_height * 4) в памяти не создаётся.
+    """
+    def __init__(self, frame_width: int, frame_height: int, resize_factor: int = 1, grid: int = 4):
+        self.grid = grid
+        self.tile_width = max(1, frame_width // resize_factor)
+        self.tile_height = max(1, frame_height // resize_factor)
+        self.buffer = np.zeros(
+            (self.tile_height * grid, self.tile_width * grid, 3),
+            dtype=np.uint8
+        )
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.buffer.shape[1], self.buffer.shape[0]
+
+    def reset(self) -> None:
+        """Очищает буфер перед новым окном (для неполных окон в конце видео)."""
+        self.buffer.fill(0)
+
+    def add(self, index: int, frame: np.ndarray) -> None:
+        """Кладёт BGR кадр в ячейку index сетки (по строкам)."""
+        x = (index % self.grid) * self.tile_width
+        y = (index // self.grid) * self.tile_height
+        tile = self.buffer[y:y + self.tile_height, x:x + self.tile_width]
+
+        if frame.shape[1] != self.tile_width or frame.shape[0] != self.tile_height:
+            frame = cv2.resize(frame, (self.tile_width, self.tile_height), interpolation=cv2.INTER_AREA)
+        # Срез буфера не непрерывен в памяти, поэтому копируем уже уменьшенную ячейку
+        tile[:] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+    def image(self) -> Image.Image:
+        # Копия, чтобы следующее окно не перезаписало уже отправленное изображение
+        return Image.fromarray(self.buffer.copy())
@@ -0,0 +1,49 @@
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+def dhash(image: np.ndarray, hash_size: int = 16) -> int:
+    """
+    Разностный хэш (dHash) RGB изображения.
+    Изображение сжимается до (hash_size + 1) x hash_size в градациях серого,
+    бит равен 1, если пиксель светлее соседа справа.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(hash_1: int, hash_2: int) -> int:
+    return (hash_1 ^ hash_2).bit_count()
+
+
+class WindowDeduplicator():
+    """
+    Поиск почти одинаковых сеток кадров.
+    Хранит хэши окон, отправленных на анализ, и для нового окна
+    возвращает номер уже проанализированного окна в пределах threshold бит.
+    """
+    def __init__(self, threshold: int = 12, hash_size: int = 16):
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.hashes = []  # (хэш, номер окна)
+        self.reused = 0
+
+    def find(self, image: np.ndarray) -> tuple[int, Optional[int]]:
+        """Возвращает (хэш окна, номер похожего окна или None)."""
+        image_hash = dhash(image, self.hash_size)
+        best_index, best_distance = None, self.threshold + 1
+        for known_hash, index in self.hashes:
+            distance = hamming(image_hash, known_hash)
+            if distance < best_distance:
+                best_index, best_distance = index, distance
+
+        if best_index is not None:
+            self.reused += 1
+        return image_hash, best_index
+
+    def add(self, image_hash: int, index: int) -> None:
+        self.hashes.append((image_hash, index))
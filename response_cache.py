@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+from pydantic import BaseModel
+
+from settings import CACHE_DIR
+
+
+class ResponseCache():
+    """
+    Постоянный кэш ответов LLM на диске.
+    Ключ - sha256 от модели, сообщений (текст промпта и base64 картинки),
+    схемы ответа и остальных параметров запроса.
+    Когда размер кэша превышает max_size_bytes, удаляются записи,
+    к которым дольше всего не обращались (LRU по времени изменения файла).
+    bypass=True - не читать кэш, но записывать свежие ответы.
+    """
+    def __init__(self, cache_dir: str = CACHE_DIR, max_size_bytes: int = 512 * 1024 * 1024, bypass: bool = False):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".json")
+        )
+
+    @staticmethod
+    def make_key(model: str, messages: list, response_format: type[BaseModel] = None, **params) -> str:
+        payload = {
+            "model": model,
+            "messages": messages,
+            "schema": response_format.model_json_schema() if response_format else None,
+            "params": params
+        }
+        data = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        if self.bypass:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    value = json.load(file)
+                os.utime(path)  # Отмечаем обращение для LRU
+                self.hits += 1
+                return value
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+
+    def put(self, key: str, value: dict) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        data = json.dumps(value, ensure_ascii=False)
+
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+            self.size_bytes += os.path.getsize(path) - old_size
+            self._evict()
+
+    def _evict(self) -> None:
+        if self.size_bytes <= self.max_size_bytes:
+            return
+
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries:
+            if self.size_bytes <= self.max_size_bytes:
+                break
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            self.size_bytes -= size
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size_bytes": self.size_bytes,
+            "bypass": self.bypass
+        }
+
+    def refreshing(self) -> "ResponseCache":
+        """
+        Тот же кэш для пересчитываемого этапа: записи не читаются,
+        свежие ответы перезаписывают старые. Счётчики и размер общие.
+        """
+        return self if self.bypass else RefreshingCache(self)
+
+
+class RefreshingCache():
+    """Обёртка над ResponseCache, которая всегда промахивается, но записывает ответы в исходный кэш."""
+    def __init__(self, cache: ResponseCache):
+        self.cache = cache
+
+    def get(self, key: str) -> Optional[dict]:
+        with self.cache._lock:
+            self.cache.misses += 1
+        return None
+
+    def put(self, key: str, value: dict) -> None:
+        self.cache.put(key, value)
+
+
+def parse_completion(client, cache: ResponseCache = None, **request) -> tuple[str, dict]:
+    """
+    Вызов client.beta.chat.completions.parse через кэш.
+    Возвращает (текст ответа, usage). При попадании в кэш токены не тратятся,
+    поэтому usage нулевой.
+    """
+    if cache is not None:
+        key = ResponseCache.make_key(**request)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached["content"], {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0}
+
+    response = client.beta.chat.completions.parse(**request)
+    content = response.choices[0].message.content
+    usage = {
+        "completion_tokens": response.usage.completion_tokens,
+        "prompt_tokens": response.usage.prompt_tokens,
+        "total_tokens": response.usage.total_tokens
+    }
+
+    if cache is not None:
+        cache.put(key, {"content": content, "usage": usage})
+
+    return content, usage
@@ -0,0 +1,128 @@
+from collections import deque
+from typing import List
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")  # Токенизатор gpt-4o
+except Exception:
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов в тексте. Без tiktoken - грубая оценка ~4 символа на токен."""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Начало текста не длиннее max_tokens токенов (с многоточием, если текст обрезан)."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:max(0, max_tokens - 1)]).rstrip() + "..."
+    return text[:max(0, (max_tokens - 1) * 4)].rstrip() + "..."
+
+
+class SceneContext():
+    """
+    Ограниченный контекст предыдущих сцен для промпта анализа кадров.
+    Последние last_k окон передаются целиком, более ранние -
+    одной короткой строкой в сводке. Сводка хранится не длиннее token_budget
+    (старые строки отбрасываются), а в промпт попадает её конец, под который
+    зарезервировано summary_share бюджета. Свежие окна, не помещающиеся
+    в остаток, обрезаются, но сводку не вытесняют, поэтому размер
+    промпта не растёт с длиной видео, а дальний контекст не теряется.
+    """
+    summary_chars = 200  # Длина описания окна в сводке
+
+    def __init__(self, last_k: int = 3, token_budget: int = 1500, summary_share: float = 0.3):
+        self.last_k = last_k
+        self.token_budget = token_budget
+        self.summary_budget = int(token_budget * summary_share)
+        self.recent = deque()
+        self.summary = deque()  # (строка сводки, число токенов)
+        self.summary_tokens = 0
+        self.dropped = 0  # Окна, которые уже не поместились даже в сводку
+
+    @staticmethod
+    def format_window(fragment: dict) -> str:
+        text = f"Стартовый таймкод: {fragment['start_timecode']}\n"
+        text += f"Конечный таймкод: {fragment['end_timecode']}\n"
+        text += f"Анализ: {fragment['analysis']}\n"
+        return text
+
+    def summarize_window(self, fragment: dict) -> str:
+        analysis = fragment['analysis']
+        if isinstance(analysis, dict):
+            analysis = analysis.get('what_is_happening', '')
+        analysis = str(analysis).replace("\n", " ")
+        if len(analysis) > self.summary_chars:
+            analysis = analysis[:self.summary_chars].rstrip() + "..."
+        return f"{fragment['start_timecode']} - {fragment['end_timecode']}: {analysis}"
+
+    def add(self, fragment: dict) -> None:
+        self.recent.append(fragment)
+        while len(self.recent) > self.last_k:
+            line = self.summarize_window(self.recent.popleft())
+            tokens = count_tokens(line)
+            self.summary.append((line, tokens))
+            self.summary_tokens += tokens
+
+        # Сводка длиннее всего бюджета в промпт всё равно не попадёт
+        while self.summary and self.summary_tokens > self.token_budget:
+            _, tokens = self.summary.popleft()
+            self.summary_tokens -= tokens
+            self.dropped += 1
+
+    def text(self) -> str:
+        """Контекст для промпта. Состояние не меняет."""
+        # Сколько сводки гарантированно остаётся в промпте
+        summary_reserved = min(self.summary_tokens, self.summary_budget)
+        recent_budget = self.token_budget - summary_reserved
+
+        recent_parts = []
+        recent_tokens = 0
+        # Свежие окна важнее - набираем их с конца, пока хватает бюджета
+        for fragment in reversed(self.recent):
+            part = self.format_window(fragment)
+            tokens = count_tokens(part)
+            if recent_tokens + tokens > recent_budget:
+                if not recent_parts:
+                    # Даже последнее окно не помещается - передаём его начало
+                    part = truncate_to_tokens(part, recent_budget)
+                    recent_parts.insert(0, part)
+                    recent_tokens += count_tokens(part)
+                break
+            recent_parts.insert(0, part)
+            recent_tokens += tokens
+
+        # Сводка забирает остаток бюджета, самые свежие строки важнее
+        summary_lines = []
+        summary_tokens = 0
+        for line, tokens in reversed(self.summary):
+            if summary_tokens + tokens > self.token_budget - recent_tokens:
+                break
+            summary_lines.insert(0, line)
+            summary_tokens += tokens
+        omitted = self.dropped + len(self.summary) - len(summary_lines)
+
+        parts = []
+        if summary_lines or omitted:
+            summary_text = "Краткое содержание предыдущих сцен:\n"
+            if omitted:
+                summary_text += f"(ещё {omitted} более ранних окон опущено)\n"
+            summary_text += "\n".join(summary_lines)
+            parts.append(summary_text + "\n")
+        parts.extend(recent_parts)
+        return "\n".join(parts)
+
+    def stats(self) -> dict:
+        return {
+            "recent_windows": len(self.recent),
+            "summary_windows": len(self.summary),
+            "dropped_windows": self.dropped,
+            "context_tokens": count_tokens(self.text())
+        }
@@ -3,7 +3,8 @@ from pydantic import BaseModel
 
 INPUT_FILES = "input_files"
 OUTPUT_FILES = "output_files"
+CACHE_DIR = "cache"
 
 class Source:
     Youtube = "Youtube"
-    Local = "Local"
\ No newline at end of file
+    Local = "Local"
@@ -0,0 +1,152 @@
+import math
+from typing import List
+
+import cv2
+import numpy as np
+
+from frame_sampler import FrameSampler
+
+
+class ShotDetector():
+    """
+    Дешёвый детектор смены планов.
+    Проходит видео один раз, берёт кадр каждые probe_interval секунд,
+    уменьшает его до probe_size и считает HSV гистограмму.
+    Склейка - место, где расстояние между соседними гистограммами
+    больше threshold. По склейкам строятся окна анализа и кадры для сетки 4x4.
+    """
+    def __init__(self, probe_interval: float = 0.5, threshold: float = 0.35, probe_size: tuple = (64, 36)):
+        self.probe_interval = probe_interval
+        self.threshold = threshold
+        self.probe_size = probe_size
+
+    def histogram(self, frame: np.ndarray) -> np.ndarray:
+        small = cv2.resize(frame, self.probe_size, interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+        hist = cv2.calcHist([hsv], [0, 1], None, [16, 16], [0, 180, 0, 256]).ravel()
+        return hist / max(hist.sum(), 1)
+
+    def detect(self, video_path: str) -> List[int]:
+        """Возвращает номера кадров, с которых начинаются новые планы."""
+        cap = cv2.VideoCapture(video_path)
+        sampler = FrameSampler(cap)
+        probe_step = max(1, int(sampler.fps * self.probe_interval))
+
+        positions = []
+        histograms = []
+        for frame_position, _, frame in sampler.read_at(range(0, sampler.total_frames, probe_step)):
+            positions.append(frame_position)
+            histograms.append(self.histogram(frame))
+        cap.release()
+
+        if len(histograms) < 2:
+            return []
+
+        # Расстояние полной вариации между соседними гистограммами, сразу для всех пар
+        distances = 0.5 * np.abs(np.diff(np.stack(histograms), axis=0)).sum(axis=1)
+        cuts = [positions[i + 1] for i in np.flatnonzero(distances > self.threshold)]
+
+        print(f"[ShotDetector] - [detect] - Found {len(cuts)} shot boundaries, sampler stats: {sampler.stats()}")
+        return cuts
+
+    @staticmethod
+    def select_frames(shots: List[tuple[int, int]], frames_per_window: int) -> List[int]:
+        """
+        Распределяет кадры сетки по планам окна пропорционально их длине,
+        минимум один кадр на план. Если планов больше, чем кадров, берутся самые длинные.
+        """
+        if len(shots) >= frames_per_window:
+            longest = sorted(shots, key=lambda shot: shot[1] - shot[0], reverse=True)[:frames_per_window]
+            return sorted((start + end) // 2 for start, end in longest)
+
+        lengths = np.array([end - start for start, end in shots], dtype=float)
+        extra = frames_per_window - len(shots)
+        shares = lengths / lengths.sum() * extra
+        counts = 1 + np.floor(shares).astype(int)
+        # Остаток раздаём по наибольшим дробным частям
+        for i in np.argsort(-(shares - np.floor(shares)))[:frames_per_window - counts.sum()]:
+            counts[i] += 1
+
+        positions = set()
+        for (start, end), count in zip(shots, counts):
+            step = (end - start) / count
+            positions.update(start + int((j + 0.5) * step) for j in range(count))
+        return sorted(positions)
+
+    def plan_windows(self,
+            total_frames: int,
+            fps: float,
+            cuts: List[int],
+            min_seconds: float,
+            max_seconds: float,
+            max_shots: int = 8,
+            frames_per_window: int = 16
+        ) -> List[dict]:
+        """
+        Нарезает видео на окна по склейкам: окно закрывается на склейке,
+        когда в нём набралось max_shots планов, или при достижении max_seconds.
+        Окно не бывает короче min_seconds (кроме последнего).
+        Окна и планы полуоткрытые: [start_frame, end_frame), поэтому кадры сетки
+        окна никогда не заходят в следующее окно.
+        """
+        min_frames = max(1, int(fps * min_seconds))
+        max_frames = max(min_frames, int(fps * max_seconds))
+
+        boundaries = sorted(set(cut for cut in cuts if 0 < cut < total_frames))
+        boundaries.append(total_frames)
+
+        windows = []
+        window_start = 0
+        shots = []
+        shot_start = 0
+        for boundary in boundaries:
+            # Длинные планы режем по max_frames
+            while boundary - window_start > max_frames:
+                split = window_start + max_frames
+                if split > shot_start:
+                    shots.append((shot_start, split))
+                windows.append(self._window(window_start, split, shots, frames_per_window))
+                window_start = shot_start = split
+                shots = []
+
+            shots.append((shot_start, boundary))
+            shot_start = boundary
+            long_enough = boundary - window_start >= min_frames
+            if (long_enough and len(shots) >= max_shots) or boundary == total_frames:
+                windows.append(self._window(window_start, boundary, shots, frames_per_window))
+                window_start = boundary
+                shots = []
+
+        return windows
+
+    def _window(self, start_frame: int, end_frame: int, shots: List[tuple[int, int]], frames_per_window: int) -> dict:
+        shots = [(start, end) for start, end in shots if end > start]  # Пустые планы кадров не дают
+        return {
+            "start_frame": start_frame,
+            "end_frame": end_frame,
+            "frame_positions": self.select_frames(shots, frames_per_window),
+            "shots": len(shots)
+        }
+
+    @staticmethod
+    def fixed_windows(total_frames: int, interval_frames: int, frames_per_window: int = 16) -> List[dict]:
+        """Окна фиксированной длины, как раньше: 16 кадров с равным шагом."""
+        frame_step = interval_frames // frames_per_window
+        return [
+            {
+                "start_frame": start_frame,
+                "end_frame": start_frame + interval_frames,
+                "frame_positions": [start_frame + i * frame_step for i in range(frames_per_window)],
+                "shots": None
+            }
+            for start_frame in range(0, total_frames, interval_frames)
+        ]
+
+    @staticmethod
+    def saved_calls(total_frames: int, interval_frames: int, windows: List[dict]) -> dict:
+        fixed = math.ceil(total_frames / interval_frames)
+        return {
+            "fixed_grid_calls": fixed,
+            "adaptive_calls": len(windows),
+            "saved_calls": fixed - len(windows)
+        }
@@ -1,63 +1,205 @@
-import librosa
-import random
-import string
-from pydub import AudioSegment
 import whisper_timestamped as whisper
+import numpy as np
+import ffmpeg
+import gc
 import os
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
 
-def generate_random_string(length: int) -> str:
-    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
+try:
+    import resource  # Нет на Windows
+except ImportError:
+    resource = None
+
+SAMPLE_RATE = 16000 # Частота дискретизации, с которой работает Whisper
+
+def load_audio_pcm(path: str, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Декодирует звук из любого файла (mp4, mp3, ...) сразу в моно float32 PCM
+    через pipe ffmpeg, без промежуточных файлов.
+    """
+    out, _ = (
+        ffmpeg
+        .input(path)
+        .output('pipe:', format='s16le', acodec='pcm_s16le', ac=1, ar=sample_rate)
+        .run(cmd=['ffmpeg', '-nostdin'], capture_stdout=True, capture_stderr=True)
+    )
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+class WhisperModelRegistry:
+    """
+    Общий на процесс реестр моделей Whisper по ключу (имя модели, устройство).
+    Модель загружается при первом запросе и переиспользуется всеми WhisperSTT.
+    """
+    _models = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, model: str = "tiny", device: str = "cpu"):
+        key = (model, device)
+        with cls._lock:
+            if key not in cls._models:
+                print(f"[WhisperModelRegistry] - [get] - Loading whisper model {model} on {device}")
+                cls._models[key] = whisper.load_model(model, device=device)
+            return cls._models[key]
+
+    @classmethod
+    def warm_up(cls, models: list[str] = ("tiny",), device: str = "cpu") -> None:
+        """Заранее загружает модели, например при старте сервиса."""
+        for model in models:
+            cls.get(model, device)
+
+    @classmethod
+    def release(cls, model: str = None, device: str = None) -> None:
+        """Выгружает модели; без аргументов - все."""
+        with cls._lock:
+            for key in list(cls._models):
+                if (model is None or key[0] == model) and (device is None or key[1] == device):
+                    del cls._models[key]
+        gc.collect()
+
+    @classmethod
+    def loaded(cls) -> list[tuple[str, str]]:
+        return list(cls._models)
+
+def find_split_points(audio: np.ndarray,
+        sample_rate: int = SAMPLE_RATE,
+        min_chunk_seconds: float = 30,
+        max_chunk_seconds: float = 120,
+        frame_seconds: float = 0.03,
+        pause_seconds: float = 0.3
+    ) -> list[int]:
+    """
+    Простой энергетический VAD: ищет паузы в речи, по которым можно резать звук.
+    Для каждого куска выбирается самое тихое место (средняя энергия за pause_seconds)
+    в диапазоне [min_chunk_seconds, max_chunk_seconds] от начала куска.
+    Возвращает номера сэмплов, по которым резать.
+    """
+    frame = max(1, int(sample_rate * frame_seconds))
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return []
+
+    rms = np.sqrt(np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    window = max(1, int(pause_seconds / frame_seconds))
+    energy = np.convolve(rms, np.ones(window) / window, mode="same")
+
+    min_frames = int(min_chunk_seconds / frame_seconds)
+    max_frames = int(max_chunk_seconds / frame_seconds)
+
+    split_points = []
+    start = 0
+    while n_frames - start > max_frames:
+        region = energy[start + min_frames:start + max_frames]
+        cut = start + min_frames + int(np.argmin(region))
+        split_points.append(cut * frame)
+        start = cut
+
+    return split_points
+
+def transcribe_chunk(audio: np.ndarray, offset: float, model: str, device: str, language: str = "ru") -> tuple[float, list, dict]:
+    """
+    Распознаёт один кусок звука в процессе-воркере (модель берётся из реестра процесса).
+    Возвращает (смещение куска, сегменты со словами, статистику воркера).
+    """
+    started = time.perf_counter()
+    transcript = whisper.transcribe(WhisperModelRegistry.get(model, device), audio, language=language, verbose=False)
+    seconds = time.perf_counter() - started
+
+    # Передаём обратно только нужные поля, чтобы не гонять лишнее через pickle
+    segments = [
+        {"words": [
+            {key: word[key] for key in ("text", "start", "end", "confidence")}
+            for word in segment["words"]
+        ]}
+        for segment in transcript["segments"]
+    ]
+    audio_seconds = len(audio) / SAMPLE_RATE
+    stats = {
+        "pid": os.getpid(),
+        "audio_seconds": audio_seconds,
+        "seconds": seconds
+    }
+    return offset, segments, stats
+
+def peak_memory_mb() -> float:
+    """Пиковый RSS процесса в МБ (0, если платформа его не отдаёт)."""
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _init_worker(torch_threads: int) -> None:
+    # Делим ядра между процессами, чтобы torch не создавал потоки на все ядра в каждом
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        pass
 
 class WhisperSTT:
-    def __init__(self, model: str = "tiny"):
-        self.duration = 0 # save the duration for keep the timing during the merge
-        self.model = whisper.load_model(model, device="cpu")
+    def __init__(self, model: str = "tiny", device: str = "cpu"):
+        self.model_name = model
+        self.device = device
+
+    @property
+    def model(self):
+        # Модель загружается лениво и одна на процесс
+        return WhisperModelRegistry.get(self.model_name, self.device)
+
+    def get_transcript(self, audio: str | np.ndarray) -> tuple[list[tuple[int, str, list, list]], str, float]:
+        """
+        Распознавание длинного звука кусками по 15 минут.
+        Звук декодируется один раз, куски - срезы одного буфера без временных файлов,
+        смещения считаются по числу сэмплов.
+        """
+        if isinstance(audio, str):
+            audio = load_audio_pcm(audio)
 
-    def get_transcript(self, audio_path: str) -> list[tuple[str, float, float]]:
         result = []
         result_string = ""
 
-        for chunk in self.chunks_audio(audio_path):
-            transcript = self.__call_whisper__(chunk[0])
-            for (path, text, start, end) in self.clean_transcript(chunk[0], transcript, result):
-                result.append((path, text, start, end))
-                result_string += f"{text}: {start[0]} - {end[-1]}\n"
-        
-        self.__clean_global__()
-        return result, result_string, AudioSegment.from_file(audio_path).duration_seconds
+        for chunk_index, (chunk, start, end) in enumerate(self.chunks_audio(audio)):
+            transcript = self.__call_whisper__(chunk)
+            for (index, text, starts, ends) in self.clean_transcript(chunk_index, transcript, offset=start):
+                result.append((index, text, starts, ends))
+                result_string += f"{text}: {starts[0]} - {ends[-1]}\n"
 
-    def clean_transcript(self, audio_path, transcript, prev_transcript) -> list[tuple[str, str, list, list]]:
+        print(f"[WhisperSTT] - [get_transcript] - Audio buffer {audio.nbytes / 2**20:.1f} MB, "
+              f"peak RSS {peak_memory_mb():.1f} MB")
+        return result, result_string, len(audio) / SAMPLE_RATE
+
+    def clean_transcript(self, chunk_index: int, transcript: dict, offset: float) -> list[tuple[int, str, list, list]]:
         print(f"Cleaning the STT...")
 
         result = []
-        
-        if len(prev_transcript) > 1:
-            audio, sample_rate = librosa.load(prev_transcript[-1][0])
-            self.duration += librosa.get_duration(y=audio, sr=sample_rate)
-
-        for i in range(0, len(transcript['segments']), 5):
-            segments = transcript['segments'][i:i+5]
-            for segment in segments:
-                    words = ' '.join([x['text'] for x in segment['words']])
-                    words_start_times = [x['start'] + self.duration for x in segment['words']]
-                    words_end_times = [x['end'] + self.duration for x in segment['words']]
-                    result.append((audio_path, words, words_start_times, words_end_times))
+
+        for segment in transcript['segments']:
+            words = ' '.join([x['text'] for x in segment['words']])
+            words_start_times = [x['start'] + offset for x in segment['words']]
+            words_end_times = [x['end'] + offset for x in segment['words']]
+            result.append((chunk_index, words, words_start_times, words_end_times))
 
         print(f"Process completed.")
         return result
             
 
-    def get_transcript_v2(self, audio_path: str, n_words_chunk: int = 4):
-        transcript = self.__call_whisper__(audio_path)
+    def get_transcript_v2(self, audio: str | np.ndarray, n_words_chunk: int = 4):
+        """audio - путь к файлу или уже декодированный PCM (float32, SAMPLE_RATE)."""
+        transcript = self.__call_whisper__(audio)
+        return self.make_subtitles(transcript['segments'], n_words_chunk)
 
+    def make_subtitles(self, segments: list, n_words_chunk: int, offset: float = 0.0, subtitle_number: int = 1) -> list[dict]:
+        """Собирает субтитры по n_words_chunk слов, сдвигая таймкоды на offset секунд."""
         result = []
-        subtitle_number = 1  # Инициализируем счетчик субтитров
 
-        for chunk in transcript['segments']:
+        for chunk in segments:
             for word_index in range(0, len(chunk['words']), n_words_chunk):
                 word_chunk = chunk['words'][word_index:word_index + n_words_chunk]
-                start_time = word_chunk[0]['start']
-                end_time = word_chunk[-1]['end']
+                start_time = word_chunk[0]['start'] + offset
+                end_time = word_chunk[-1]['end'] + offset
                 word = ' '.join([x['text'] for x in word_chunk])
                 confidence = sum([x['confidence'] for x in word_chunk]) / len(word_chunk)
 
@@ -73,40 +215,112 @@ class WhisperSTT:
                 subtitle_number += 1  # Увеличиваем счетчик для следующего субтитра
 
         return result
+
+    def get_transcript_parallel(self,
+            audio: str | np.ndarray,
+            n_words_chunk: int = 4,
+            workers: int = None,
+            min_chunk_seconds: float = 30,
+            max_chunk_seconds: float = 120
+        ) -> list[dict]:
+        """
+        Параллельное распознавание: звук режется по паузам (find_split_points),
+        куски распознаются в пуле процессов, таймкоды слов сдвигаются на начало куска.
+        Формат результата как у get_transcript_v2.
+        """
+        return list(self.iter_transcript(
+            audio,
+            n_words_chunk=n_words_chunk,
+            workers=workers or os.cpu_count() or 1,
+            min_chunk_seconds=min_chunk_seconds,
+            max_chunk_seconds=max_chunk_seconds
+        ))
+
+    def iter_transcript(self,
+            audio: str | np.ndarray,
+            n_words_chunk: int = 4,
+            workers: int = None,
+            min_chunk_seconds: float = 30,
+            max_chunk_seconds: float = 120
+        ) -> Iterator[dict]:
+        """
+        Потоковое распознавание: отдаёт субтитры (формат get_transcript_v2)
+        по мере готовности каждого куска, не дожидаясь конца всего звука.
+        Куски режутся по паузам; workers > 1 - куски распознаются в пуле процессов,
+        но отдаются всё равно по порядку.
+        """
+        if isinstance(audio, str):
+            audio = load_audio_pcm(audio)
+
+        split_points = find_split_points(
+            audio,
+            min_chunk_seconds=min_chunk_seconds,
+            max_chunk_seconds=max_chunk_seconds
+        )
+        bounds = list(zip([0] + split_points, split_points + [len(audio)]))
+        workers = max(1, min(workers or 1, len(bounds)))
+        print(f"[WhisperSTT] - [iter_transcript] - {len(bounds)} chunks on {workers} workers")
+
+        subtitle_number = 1
+        worker_stats = {}
+        for offset, segments, stats in self._transcribe_chunks(audio, bounds, workers):
+            subtitles = self.make_subtitles(segments, n_words_chunk, offset=offset, subtitle_number=subtitle_number)
+            subtitle_number += len(subtitles)
+
+            totals = worker_stats.setdefault(stats["pid"], {"audio_seconds": 0.0, "seconds": 0.0})
+            totals["audio_seconds"] += stats["audio_seconds"]
+            totals["seconds"] += stats["seconds"]
+
+            yield from subtitles
+
+        for pid, totals in worker_stats.items():
+            # RTF < 1 - быстрее реального времени
+            rtf = totals["seconds"] / max(totals["audio_seconds"], 1e-6)
+            print(f"[WhisperSTT] - [iter_transcript] - Worker {pid}: "
+                  f"{totals['audio_seconds']:.1f}s audio in {totals['seconds']:.1f}s, RTF {rtf:.3f}")
+
+    def _transcribe_chunks(self, audio: np.ndarray, bounds: list[tuple[int, int]], workers: int) -> Iterator[tuple[float, list, dict]]:
+        """Распознаёт куски по порядку: в этом процессе или в пуле из workers процессов."""
+        if workers == 1:
+            for start, end in bounds:
+                yield transcribe_chunk(audio[start:end], start / SAMPLE_RATE, self.model_name, self.device)
+            return
+
+        # spawn: fork процесса с уже инициализированным torch может зависнуть
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(max(1, (os.cpu_count() or 1) // workers),)
+        ) as executor:
+            futures = [
+                executor.submit(transcribe_chunk, audio[start:end], start / SAMPLE_RATE, self.model_name, self.device)
+                for start, end in bounds
+            ]
+            for future in futures:
+                yield future.result()
     
-    def chunks_audio(self, audio_path: str):
-        audio = AudioSegment.from_file(audio_path)
-        size = self.calc_chunks_size(audio.duration_seconds)
-        chunk_duration = audio.duration_seconds / size
-        chunks = []
+    def chunks_audio(self, audio: np.ndarray):
+        """Режет буфер на равные куски; отдаёт (срез без копирования, начало, конец в секундах)."""
+        duration = len(audio) / SAMPLE_RATE
+        size = self.calc_chunks_size(duration)
+        bounds = np.linspace(0, len(audio), size + 1).astype(int)
 
         print(f"\nChunking the audio...")
-        print(f"Duration: {audio.duration_seconds}")
-        print(f"Single Chunk Duration: {chunk_duration}")
+        print(f"Duration: {duration}")
+        print(f"Single Chunk Duration: {duration / size}")
         print(f"Size: {size}\n")
 
-        # Create 'tmp' directory if it doesn't exist
-        os.makedirs('tmp', exist_ok=True)
-
-        for i in range(size):
-            start = i * chunk_duration * 1000  # pydub works with milliseconds
-            end = (i + 1) * chunk_duration * 1000
-            tmp_audio = f"tmp/{generate_random_string(16)}.mp3"
-            audio_chunk = audio[start:end]
-            audio_chunk.export(tmp_audio, format="mp3")
-            chunks.append((tmp_audio, start/1000, end/1000))
-
-        return chunks
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield audio[start:end], start / SAMPLE_RATE, end / SAMPLE_RATE
     
     @staticmethod
     def calc_chunks_size(duration):
         return max(1, int((duration / 60) / 15))
 
-    def __call_whisper__(self, audio_path):
-        print(f'\nLoading audio {audio_path}...')
-        audio = whisper.load_audio(audio_path)
+    def __call_whisper__(self, audio: str | np.ndarray):
+        if isinstance(audio, str):
+            print(f'\nLoading audio {audio}...')
+            audio = load_audio_pcm(audio)
         transcript = whisper.transcribe(self.model, audio, language="ru", verbose=False)
-        return transcript
-
-    def __clean_global__(self):
-        self.duration = 0
\ No newline at end of file
+        return transcript
\ No newline at end of file
@@ -1,18 +1,22 @@
-from typing import List
+from typing import Callable, Iterator, List
 
 from pydantic import BaseModel
 
 from settings import Source
 from settings import OUTPUT_FILES
-from stt import WhisperSTT
+from stt import WhisperSTT, load_audio_pcm
 
 import re
 
 from youtube_transcript_api import YouTubeTranscriptApi
-from pydub import AudioSegment
 from aicorrection import AICorrection
+from response_cache import ResponseCache
+from artifact_sink import ArtifactSink
+from checkpoints import CheckpointStore, data_hash
+from functools import partial
 
 import ffmpeg
+import numpy as np
 import json
 import os
 
@@ -65,14 +69,25 @@ class SubtitlesAnalysis():
     Анализ субтитров.
     Берёт субтитры и анализирует их.
     """
+    def __init__(self, 
+            cache: ResponseCache = None, 
+            whisper_model: str = "tiny", 
+            whisper_device: str = "cpu",
+            transcription_workers: int = None,
+            correction_confidence_threshold: float = None
+        ):
+        self.cache = cache
+        self.whisper_model = whisper_model
+        self.whisper_device = whisper_device
+        # Если задано, звук режется по паузам и распознаётся в пуле из стольких процессов
+        self.transcription_workers = transcription_workers
+        # Если задано, в коррекцию уходят только субтитры с меньшей уверенностью
+        self.correction_confidence_threshold = correction_confidence_threshold
 
-    def get_audio(self, video_path: str) -> str:
-        output_path = video_path.rsplit('.', 1)[0] + '.mp3'
-        
+    def get_audio(self, video_path: str) -> np.ndarray:
+        """Звук видео в виде PCM для Whisper (16 кГц, моно, float32), без промежуточного mp3."""
         try:
-            audio = AudioSegment.from_file(video_path, format="mp4")
-            audio.export(output_path, format="mp3")
-            return output_path
+            return load_audio_pcm(video_path)
         except Exception as e:
             print(f'Error occurred: {str(e)}')
             return None
@@ -86,43 +101,160 @@ class SubtitlesAnalysis():
         return subtitles
 
     def get_local_subtitles(self, video_path: str):
-        audio_path = self.get_audio(video_path)
+        audio = self.get_audio(video_path)
 
-        extractor = WhisperSTT("tiny")
-        transcript = extractor.get_transcript_v2(
-            audio_path=audio_path,
-            n_words_chunk=10
-        )
+        extractor = WhisperSTT(self.whisper_model, self.whisper_device)
+        if self.transcription_workers:
+            transcript = extractor.get_transcript_parallel(
+                audio=audio,
+                n_words_chunk=10,
+                workers=self.transcription_workers
+            )
+        else:
+            transcript = extractor.get_transcript_v2(
+                audio=audio,
+                n_words_chunk=10
+            )
 
         return transcript
 
+    def stream_local_subtitles(self, video_path: str, ndjson_path: str = None) -> Iterator[dict]:
+        """
+        Отдаёт субтитры по мере распознавания кусков звука.
+        Если задан ndjson_path, каждая запись сразу дописывается в файл (одна JSON строка на субтитр).
+        """
+        audio = self.get_audio(video_path)
+        extractor = WhisperSTT(self.whisper_model, self.whisper_device)
+        entries = extractor.iter_transcript(
+            audio=audio,
+            n_words_chunk=10,
+            workers=self.transcription_workers
+        )
+
+        if ndjson_path is None:
+            yield from entries
+            return
+
+        with open(ndjson_path, 'w', encoding='utf-8') as ndjson_file:
+            for entry in entries:
+                ndjson_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                ndjson_file.flush()
+                yield entry
+
     def AI_analysis(self, subtitles: List[dict]):
-        corrector = AICorrection()
+        corrector = AICorrection(
+            cache=self.cache,
+            confidence_threshold=self.correction_confidence_threshold
+        )
         corrected_subtitles, total_tokens = corrector.run(subtitles)
 
         return corrected_subtitles, total_tokens
 
+    def iter_local_subtitles(self,
+            video_path: str,
+            ndjson_path: str = None,
+            on_subtitle: Callable[[dict], None] = None
+        ) -> Iterator[dict]:
+        for entry in self.stream_local_subtitles(video_path, ndjson_path):
+            if on_subtitle is not None:
+                on_subtitle(entry)
+            yield entry
+
+    def transcribe(self,
+            source: str,
+            video_path: str = None,
+            youtube_video_url: str = None,
+            ndjson_path: str = None,
+            on_subtitle: Callable[[dict], None] = None
+        ) -> List[dict]:
+        if source == Source.Local and (ndjson_path or on_subtitle):
+            subtitles = list(self.iter_local_subtitles(video_path, ndjson_path, on_subtitle))
+        elif source == Source.Local:
+            subtitles = self.get_local_subtitles(video_path)
+        elif source == Source.Youtube:
+            subtitles = self.get_youtube_subtitles(youtube_video_url)
+        else:
+            raise ValueError(f"Invalid source: {source}")
+
+        return subtitles
+
+    def streams_correction(self, source: str) -> bool:
+        """
+        Коррекция идёт параллельно с распознаванием, если распознавание потоковое
+        (локальное видео, куски по паузам) и не нужен отбор по уверенности по всем субтитрам.
+        """
+        return source == Source.Local and bool(self.transcription_workers) and self.correction_confidence_threshold is None
+
+    def transcribe_and_correct(self, entries: Iterator[dict]) -> tuple[List[dict], dict, int]:
+        """Окна коррекции уходят в LLM, пока следующие куски звука ещё распознаются."""
+        subtitles = []
+
+        def record() -> Iterator[dict]:
+            for entry in entries:
+                subtitles.append(entry)
+                yield entry
+
+        analysis, total_tokens = self.AI_analysis(record())
+        return subtitles, analysis, total_tokens
+
     def run(self, 
             output_json: str, 
             source: str = Source.Local, 
             video_path: str = None, 
             youtube_video_url: str = None,
-            interval_seconds: int = 300
+            interval_seconds: int = 300,
+            ndjson_path: str = None,
+            on_subtitle: Callable[[dict], None] = None,
+            sink: ArtifactSink = None,
+            checkpoints: CheckpointStore = None
         ) -> List[dict]:
         """
         Анализ субтитров. Возвращает json-объект с субтитрами.
+        sink - если передан, output_json записывается через него в фоне.
+        ndjson_path / on_subtitle - для локального видео субтитры ещё до коррекции
+        пишутся в NDJSON и передаются в on_subtitle по мере распознавания.
+        Если задано transcription_workers (и нет порога уверенности), коррекция окон
+        начинается, пока распознавание ещё идёт (см. streams_correction).
+        checkpoints - распознавание и коррекция сохраняются как отдельные этапы
+        и не пересчитываются при повторном запуске.
         """
+        transcribe = partial(self.transcribe, source, video_path, youtube_video_url, ndjson_path, on_subtitle)
+        stream = partial(self.iter_local_subtitles, video_path, ndjson_path, on_subtitle)
 
-        if source == Source.Local:
-            subtitles = self.get_local_subtitles(video_path)
-        elif source == Source.Youtube:
-            subtitles = self.get_youtube_subtitles(youtube_video_url)
+        if checkpoints is None:
+            if self.streams_correction(source):
+                _, analysis, total_tokens = self.transcribe_and_correct(stream())
+            else:
+                subtitles = transcribe()
+                analysis, total_tokens = self.AI_analysis(subtitles)
         else:
-            raise ValueError(f"Invalid source: {source}")
+            transcription_params = {
+                "source": source,
+                "whisper_model": self.whisper_model,
+                "vad_chunks": bool(self.transcription_workers)
+            }
+
+            def correction_params(subtitles: List[dict]) -> dict:
+                return {"subtitles": data_hash(subtitles), "confidence_threshold": self.correction_confidence_threshold}
 
-        analysis, total_tokens = self.AI_analysis(subtitles)
+            found, _ = checkpoints.load("transcription", transcription_params)
+            if self.streams_correction(source) and not found:
+                subtitles, analysis, total_tokens = self.transcribe_and_correct(stream())
+                checkpoints.save("transcription", transcription_params, subtitles)
+                checkpoints.save("correction", correction_params(subtitles), [analysis, total_tokens])
+            else:
+                subtitles = checkpoints.cached("transcription", transcription_params, transcribe)
+                analysis, total_tokens = checkpoints.cached(
+                    "correction",
+                    correction_params(subtitles),
+                    partial(self.AI_analysis, subtitles),
+                    tokens=lambda data: data[1]
+                )
 
-        with open(output_json, 'w', encoding='utf-8') as json_file:
-            json.dump(analysis, json_file, ensure_ascii=False, indent=4)
+        if sink is not None:
+            sink.write(output_json, analysis)
+        elif output_json is not None:
+            with open(output_json, 'w', encoding='utf-8') as json_file:
+                json.dump(analysis, json_file, ensure_ascii=False, indent=4)
 
-        return analysis, total_tokens
\ No newline at end of file
+        return analysis, total_tokens
@@ -0,0 +1,63 @@
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List
+
+
+class SubtitleStore():
+    """
+    Субтитры с индексами для быстрых выборок.
+    По номеру (subtitle_number) - словарь, O(1).
+    По времени - субтитры отсортированы по началу, поиск через bisect, O(log n + k).
+    Одно хранилище используется промптами ассистентов, конкатенацией и нарезкой клипов.
+    """
+    def __init__(self, subtitles: List[dict]):
+        self.subtitles = subtitles
+        self.by_number = {subtitle["subtitle_number"]: subtitle for subtitle in subtitles if "subtitle_number" in subtitle}
+
+        self.order = sorted(range(len(subtitles)), key=lambda i: subtitles[i]["start_timecode"])
+        self.starts = [subtitles[i]["start_timecode"] for i in self.order]
+        self.ends = [subtitles[i]["end_timecode"] for i in self.order]
+        # Субтитр, начавшийся раньше отрезка, может в него заходить, но не дальше самого длинного субтитра
+        self.max_duration = max((end - start for start, end in zip(self.starts, self.ends)), default=0)
+
+    def __len__(self) -> int:
+        return len(self.subtitles)
+
+    def get(self, number: int) -> dict:
+        return self.by_number.get(number)
+
+    def text(self, numbers: Iterable[int]) -> str:
+        """Текст субтитров с указанными номерами; неизвестные номера пропускаются."""
+        return " ".join(
+            self.by_number[number]["subtitle"]
+            for number in numbers
+            if number in self.by_number
+        )
+
+    def span(self, numbers: Iterable[int], max_gap: int = 2) -> tuple[float, float]:
+        """
+        (начало, конец) отрезка, покрывающего субтитры с указанными номерами, или None.
+        Номера, оторванные от остальных больше чем на max_gap, не учитываются:
+        берётся самая длинная группа номеров, идущих подряд (с пропусками до max_gap).
+        """
+        known = sorted({number for number in numbers if number in self.by_number})
+        if not known:
+            return None
+
+        groups = [[known[0]]]
+        for number in known[1:]:
+            if number - groups[-1][-1] <= max_gap:
+                groups[-1].append(number)
+            else:
+                groups.append([number])
+        found = [self.by_number[number] for number in max(groups, key=len)]
+        return (
+            min(subtitle["start_timecode"] for subtitle in found),
+            max(subtitle["end_timecode"] for subtitle in found)
+        )
+
+    def overlapping(self, start: float, end: float) -> List[dict]:
+        """Субтитры, пересекающиеся с [start, end], в исходном порядке."""
+        low = bisect_left(self.starts, start - self.max_duration)
+        high = bisect_right(self.starts, end)
+        matching = sorted(self.order[i] for i in range(low, high) if self.ends[i] >= start)
+        return [self.subtitles[i] for i in matching]
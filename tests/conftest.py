@@ -0,0 +1,21 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def synthetic_video(tmp_path):
+    """Небольшое видео MJPG 320x240, 25 fps, 100 кадров со сменой сцены посередине."""
+    path = str(tmp_path / "synthetic.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 25, (320, 240))
+    for index in range(100):
+        frame = np.full((240, 320, 3), 40 if index < 50 else 200, dtype=np.uint8)
+        cv2.putText(frame, str(index), (20, 120), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 255), 3)
+        writer.write(frame)
+    writer.release()
+    return path
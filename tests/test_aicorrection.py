@@ -0,0 +1,71 @@
+import os
+import threading
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from aicorrection import AICorrection
+
+
+def make_subtitles(count: int) -> list[dict]:
+    return [
+        {"subtitle_number": i, "start_timecode": i, "end_timecode": i + 1, "subtitle": f"слово {i}", "confidence": 0.5}
+        for i in range(1, count + 1)
+    ]
+
+
+def fake_correct_window(prompt: str):
+    numbers = [int(line.split()[2]) for line in prompt.splitlines() if line.startswith("Subtitle Number:")]
+    corrected = [
+        {"subtitle_number": n, "start_timecode": n, "end_timecode": n + 1, "subtitle": f"исправлено {n}", "confidence": 1.0}
+        for n in numbers
+    ]
+    return corrected, {"completion_tokens": 1, "prompt_tokens": 1, "total_tokens": 2}, 0.0
+
+
+def test_stream_correction_matches_batch_and_starts_before_end(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("aicorrection_output")
+    subtitles = make_subtitles(57)
+
+    batch = AICorrection(window_size=10, overlap=3)
+    batch.correct_window = fake_correct_window
+    expected = batch.run(list(subtitles))
+
+    streaming = AICorrection(window_size=10, overlap=3)
+    first_window_sent = threading.Event()
+    sent_before_end = []
+
+    def correct_window(prompt):
+        first_window_sent.set()
+        return fake_correct_window(prompt)
+
+    def entries():
+        for index, entry in enumerate(subtitles):
+            if index == len(subtitles) - 1:
+                # Первое окно должно уйти в LLM до конца распознавания
+                sent_before_end.append(first_window_sent.wait(timeout=5))
+            yield entry
+
+    streaming.correct_window = correct_window
+    assert streaming.run(entries()) == expected
+    assert sent_before_end == [True]
+
+
+def test_renumbered_window_is_counted_as_dropped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("aicorrection_output")
+    subtitles = make_subtitles(20)
+
+    def renumbering_correct_window(prompt):
+        corrected, usage, latency = fake_correct_window(prompt)
+        if corrected[0]["subtitle_number"] != 1:
+            # Второе окно модель пронумеровала заново с 1
+            corrected = [{**item, "subtitle_number": i} for i, item in enumerate(corrected, 1)]
+        return corrected, usage, latency
+
+    corrector = AICorrection(window_size=10, overlap=0)
+    corrector.correct_window = renumbering_correct_window
+    result, _ = corrector.run(list(subtitles))
+
+    assert [stats["dropped"] for stats in corrector.window_stats] == [0, 10]
+    assert [item["subtitle"] for item in result["subtitles"][10:]] == [f"слово {i}" for i in range(11, 21)]
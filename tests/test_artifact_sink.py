@@ -0,0 +1,16 @@
+import json
+
+import pytest
+
+from artifact_sink import ArtifactSink
+
+
+def test_pending_writes_finish_when_pipeline_raises(tmp_path):
+    path = tmp_path / "artifact.json"
+
+    with pytest.raises(RuntimeError):
+        with ArtifactSink() as sink:
+            sink.write(str(path), {"subtitles": [1, 2, 3]})
+            raise RuntimeError("stage failed")
+
+    assert json.loads(path.read_text(encoding="utf-8")) == {"subtitles": [1, 2, 3]}
@@ -0,0 +1,29 @@
+from checkpoints import CheckpointStore
+from response_cache import ResponseCache
+
+
+def test_reused_stage_tokens_are_reported_separately(tmp_path):
+    params = {"client_wants": "смешные моменты"}
+    first = CheckpointStore(str(tmp_path), "input")
+    first.cached("assistant_1", params, lambda: [{}, 1, 2, 3], tokens=lambda data: data[3])
+    assert first.reused_tokens == {}
+
+    second = CheckpointStore(str(tmp_path), "input")
+    second.cached("assistant_1", params, lambda: [{}, 0, 0, 0], tokens=lambda data: data[3])
+    assert second.reused_tokens == {"assistant_1": 3}
+
+    other_wants = CheckpointStore(str(tmp_path), "input")
+    other_wants.cached("assistant_1", {"client_wants": "споры"}, lambda: [{}, 0, 0, 5], tokens=lambda data: data[3])
+    assert other_wants.reused == []
+
+
+def test_refreshing_cache_skips_reads_and_overwrites(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path))
+    cache.put("key", {"content": "old"})
+
+    refreshing = cache.refreshing()
+    assert refreshing.get("key") is None
+    refreshing.put("key", {"content": "new"})
+
+    assert cache.get("key") == {"content": "new"}
+    assert cache.stats()["misses"] == 1
@@ -0,0 +1,19 @@
+import ffmpeg
+
+from clip_export import ClipExporter
+
+
+def test_smart_cut_error_falls_back_to_reencode():
+    exporter = ClipExporter(mode="accurate")
+    exporter._streams["in.mp4"] = {"codec_name": "h264", "profile": "High", "level": 40, "fps": 25.0, "start_time": 0.0, "has_audio": False}
+    exporter._keyframes["in.mp4"] = [0.0, 2.0, 4.0]
+    reencoded = []
+
+    def head_reencode(*args):
+        raise ffmpeg.Error("ffmpeg", b"", b"Stream map 'audio' matches no streams.")
+
+    exporter._head_reencode = head_reencode
+    exporter._reencode = lambda *args: reencoded.append(args)
+
+    assert exporter.export_many("in.mp4", [(1.0, 5.0, "a.mp4"), (1.5, 6.0, "b.mp4")]) == ["reencode", "reencode"]
+    assert [args[-1] for args in reencoded] == ["a.mp4", "b.mp4"]
@@ -0,0 +1,44 @@
+import numpy as np
+
+from face_cropping import CenterFilter, frame_geometry, stream_rotation
+
+
+def test_center_filter_smooths_noisy_stationary_track():
+    detect_every = 5
+    rng = np.random.default_rng(0)
+    center_filter = CenterFilter(steps_per_measurement=detect_every)
+
+    raw, smoothed = [], []
+    for frame_index in range(1500):
+        measured = None
+        if frame_index % detect_every == 0:
+            measured = 0.5 + rng.normal(0, 0.02)
+            raw.append(measured)
+        center = center_filter.update(measured)
+        if measured is not None:
+            smoothed.append(center)
+
+    # Без начального участка, пока фильтр сходится
+    assert np.var(smoothed[20:]) < 0.75 * np.var(raw[20:])
+    assert abs(np.mean(smoothed[20:]) - 0.5) < 0.01
+
+
+def test_stream_rotation_from_tag_and_displaymatrix():
+    assert stream_rotation({"tags": {"rotate": "90"}}) == 90
+    assert stream_rotation({"side_data_list": [{"side_data_type": "Display Matrix", "rotation": -90}]}) == 270
+    assert stream_rotation({"tags": {}}) == 0
+
+
+def test_frame_geometry_tracks_sources_wider_than_clip():
+    size = (720, 1280)
+    for width, height in [(1920, 1080), (1440, 1080), (1080, 1440), (1080, 1920), (720, 1680)]:
+        geometry = frame_geometry(width, height, size)
+        assert geometry["track"] == (width / height > 720 / 1280)
+        assert geometry["scaled_width"] >= 720 and geometry["scaled_height"] >= 1280
+        if geometry["track"]:
+            # Есть что кадрировать: кадр после масштабирования шире клипа
+            assert geometry["scaled_width"] > 720
+            assert geometry["scaled_height"] == 1280
+
+    assert frame_geometry(1920, 1080, size)["scaled_width"] == 2276
+    assert frame_geometry(1080, 1920, size) == {"scaled_width": 720, "scaled_height": 1280, "track": False}
@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+
+from frame_sampler import FrameSampler
+
+
+def read_frames(video_path: str, positions: list[int], seek_threshold) -> tuple[list, FrameSampler]:
+    cap = cv2.VideoCapture(video_path)
+    sampler = FrameSampler(cap, seek_threshold=seek_threshold)
+    frames = list(sampler.read_at(positions))
+    cap.release()
+    return frames, sampler
+
+
+def test_seeking_returns_same_frames_as_sequential_decode(synthetic_video):
+    positions = [0, 3, 40, 41, 90, 99]
+
+    sequential, sequential_sampler = read_frames(synthetic_video, positions, seek_threshold=None)
+    seeked, seeked_sampler = read_frames(synthetic_video, positions, seek_threshold=10)
+
+    assert [position for position, _, _ in seeked] == positions
+    assert sequential_sampler.seeks == 0
+    assert seeked_sampler.seeks == 2
+    assert seeked_sampler.frames_decoded < sequential_sampler.frames_decoded
+    for (_, _, expected), (_, _, actual) in zip(sequential, seeked):
+        assert np.array_equal(expected, actual)
@@ -0,0 +1,29 @@
+from pydantic import BaseModel
+
+from highlight_selection import HighlightSelector
+from scene_context import count_tokens
+
+
+class Fragments(BaseModel):
+    fragments: list
+
+
+def test_map_prompts_fit_budget_with_long_client_wants():
+    requests = []
+
+    def analyze(text, prompt, response_format):
+        requests.append(count_tokens(prompt + text))
+        return {"fragments": []}, 0, 0, 0
+
+    selector = HighlightSelector(analyze=analyze, response_format=Fragments, token_budget=1500)
+    client_wants = "Нужны моменты, где ведущие спорят о футболе и шутят над гостями. " * 40
+    fragment_texts = [
+        f"Окно {index}: 00:{index:02d}:00 - 00:{index:02d}:30. Ведущий рассказывает историю про матч и смеётся."
+        for index in range(60)
+    ]
+
+    selector.map(fragment_texts, client_wants)
+
+    assert count_tokens(client_wants) > 500
+    assert len(requests) > 1
+    assert max(requests) <= 1500
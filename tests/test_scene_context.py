@@ -0,0 +1,25 @@
+from scene_context import SceneContext, count_tokens
+
+
+def make_window(index: int, analysis: str) -> dict:
+    return {
+        "start_timecode": f"00:00:{index:02d},000",
+        "end_timecode": f"00:00:{index + 1:02d},000",
+        "analysis": {"what_is_happening": analysis}
+    }
+
+
+def test_long_recent_windows_keep_summary_and_budget():
+    context = SceneContext(last_k=2, token_budget=300)
+    for index in range(6):
+        context.add(make_window(index, f"сцена {index}"))
+    context.add(make_window(6, "очень длинное описание " * 200))
+
+    text = context.text()
+    assert "Краткое содержание предыдущих сцен" in text
+    assert count_tokens(text) <= 300 + 10
+    # text() не меняет состояние: повторный вызов и stats дают тот же результат
+    assert context.text() == text
+    context.stats()
+    assert context.text() == text
+    assert context.dropped == 0
@@ -0,0 +1,15 @@
+import pytest
+
+from shot_detection import ShotDetector
+
+
+@pytest.mark.parametrize("cuts", [[150, 300], [100, 150, 600], [300, 600, 900], [], [1, 2, 3, 999]])
+def test_window_frames_stay_inside_half_open_window(cuts):
+    windows = ShotDetector().plan_windows(1000, 25, cuts, min_seconds=2, max_seconds=12)
+
+    assert windows[0]["start_frame"] == 0 and windows[-1]["end_frame"] == 1000
+    for window, following in zip(windows, windows[1:]):
+        assert window["end_frame"] == following["start_frame"]
+    for window in windows:
+        assert window["frame_positions"]
+        assert all(window["start_frame"] <= position < window["end_frame"] for position in window["frame_positions"])
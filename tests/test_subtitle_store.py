@@ -0,0 +1,16 @@
+from subtitle_store import SubtitleStore
+
+
+def make_subtitles(count: int) -> list[dict]:
+    return [
+        {"subtitle_number": number, "start_timecode": number * 3.0, "end_timecode": number * 3.0 + 2.5, "subtitle": f"s{number}"}
+        for number in range(1, count + 1)
+    ]
+
+
+def test_span_ignores_outlier_numbers():
+    store = SubtitleStore(make_subtitles(500))
+
+    assert store.span([10, 11, 13, 500]) == (30.0, 41.5)
+    assert store.span([1, 500]) == (3.0, 5.5)
+    assert store.span([1000]) is None
@@ -0,0 +1,20 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from video_analysis import VideoAnalysis
+
+
+def test_run_builds_mosaic_at_constructor_resize_factor(synthetic_video):
+    video_analysis = VideoAnalysis(resize_factor=4)
+    sizes = []
+
+    def analyze(image, prompt_params=None, resize_factor=1):
+        sizes.append(image.size)
+        return {"what_is_happening": "test"}, 0
+
+    video_analysis.image_analysis.analyze = analyze
+    video_analysis.run(output_json=None, video_path=synthetic_video, interval_seconds=2)
+
+    # Сетка 4x4 из кадров 320x240, уменьшенных в 4 раза
+    assert sizes and set(sizes) == {(320, 240)}
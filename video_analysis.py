@@ -2,6 +2,8 @@ import base64
 import json
 import os
 import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from typing import List
 
@@ -20,6 +22,13 @@ import yt_dlp
 from pathlib import Path
 
 from image_analysis import ImageAnalysis
+from frame_sampler import FrameSampler
+from mosaic import MosaicBuilder
+from scene_context import SceneContext
+from response_cache import ResponseCache
+from shot_detection import ShotDetector
+from perceptual_hash import WindowDeduplicator
+from artifact_sink import ArtifactSink
 
 load_dotenv()
 
@@ -29,10 +38,14 @@ class VideoAnalysis():
     Анализ видео.
     Берёт кадры из видео и анализирует их.
     """
-    def __init__(self, api_key: str = None, resize_factor: int = 1):
+    frames_per_analysis = 16 # Кадров в одной сетке 4x4
+
+    def __init__(self, api_key: str = None, resize_factor: int = 1, cache: ResponseCache = None):
+        self.resize_factor = resize_factor # Во сколько раз уменьшается сетка кадров, если run не задаёт своё
         self.image_analysis = ImageAnalysis(
             api_key=api_key,
-            resize_factor=resize_factor
+            resize_factor=resize_factor,
+            cache=cache
         )
         print("[VideoAnalysis] - [__init__] - Initialized VideoAnalysis class")
 
@@ -62,22 +75,35 @@ class VideoAnalysis():
         print(f"[VideoAnalysis] - [yt_download] - Downloaded video to {video_file}")
         return str(video_file)  # Return path to file
 
-    def make_analysis_text(self, analysis_results: List[dict]) -> str:
-        analysis_text = ""
-        for fragment in analysis_results:
-            analysis_text += f"Стартовый таймкод: {fragment['start_timecode']}\n"
-            analysis_text += f"Конечный таймкод: {fragment['end_timecode']}\n"
-            analysis_text += f"Анализ: {fragment['analysis']}\n"
-            analysis_text += "\n"
-        return analysis_text
-
     def run(self, 
             output_json: str, 
             source: str = Source.Local, 
             video_path: str = None, 
             youtube_video_url: str = None,
-            resize_factor: int = 1,
-            interval_seconds: int = 1) -> List[dict]:
+            resize_factor: int = None,
+            interval_seconds: int = 1,
+            max_in_flight: int = 1,
+            context_windows: int = 3,
+            context_token_budget: int = 1500,
+            adaptive_windows: bool = False,
+            dedup_threshold: int = None,
+            sink: ArtifactSink = None) -> List[dict]:
+        """
+        resize_factor - во сколько раз уменьшается сетка кадров (по умолчанию - из конструктора).
+        sink - если передан, output_json записывается через него в фоне.
+        dedup_threshold - если задан, для каждой сетки считается dHash, и окно,
+        отличающееся от уже проанализированного не больше чем на dedup_threshold бит,
+        не отправляется в LLM: берётся анализ того окна со сдвинутыми таймкодами
+        и помечается полем reused_from.
+        adaptive_windows - окна и кадры для сетки выбираются по склейкам (ShotDetector):
+        статичные планы объединяются в окна до 3 * interval_seconds,
+        в быстром монтаже окно закрывается раньше (не короче interval_seconds / 2).
+        max_in_flight - сколько запросов к LLM может выполняться одновременно.
+        Пока запросы ждут ответа, декодируются следующие окна.
+        Контекст scene собирается из уже завершённых окон, идущих подряд с начала видео:
+        последние context_windows окон целиком и краткая сводка более ранних,
+        всё вместе не больше context_token_budget токенов.
+        """
         print(f"[VideoAnalysis] - [run] - Starting video analysis with source: {source}")
 
         if source == Source.Local:
@@ -93,77 +119,152 @@ class VideoAnalysis():
         else:
             raise ValueError(f"Invalid source: {source}")
         
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        sampler = FrameSampler(cap)
+        fps = sampler.fps
+        total_frames = sampler.total_frames
         interval_frames = int(fps * interval_seconds)
-        frames_per_analysis = 16
-        frame_step = interval_frames // frames_per_analysis
+        frames_per_analysis = self.frames_per_analysis
+
+        detector = ShotDetector()
+        if adaptive_windows:
+            windows = detector.plan_windows(
+                total_frames,
+                fps,
+                cuts=detector.detect(video_path),
+                min_seconds=interval_seconds / 2,
+                max_seconds=interval_seconds * 3,
+                frames_per_window=frames_per_analysis
+            )
+            print(f"[VideoAnalysis] - [run] - Adaptive windows: {detector.saved_calls(total_frames, interval_frames, windows)}")
+        else:
+            windows = detector.fixed_windows(total_frames, interval_frames, frames_per_analysis)
         
         frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         
+        # Сетка 4x4 собирается сразу в итоговом разрешении
+        if resize_factor is None:
+            resize_factor = self.resize_factor
+        mosaic = MosaicBuilder(frame_width, frame_height, resize_factor=resize_factor)
+        print(f"[VideoAnalysis] - [run] - Contact sheet size: {mosaic.size}")
+
         analysis_results = []
+        scene_context = SceneContext(last_k=context_windows, token_budget=context_token_budget)
         
         total_tokens = 0
-        for start_frame in range(0, total_frames, interval_frames):
-            combined_image = Image.new('RGB', (frame_width * 4, frame_height * 4))
+        executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight))
+        deduplicator = WindowDeduplicator(threshold=dedup_threshold) if dedup_threshold is not None else None
+        in_flight = deque()  # (future, window, timecodes, reused_from) в порядке окон
+
+        def collect_oldest() -> int:
+            future, window, window_timecodes, reused_from = in_flight.popleft()
+            if reused_from is None:
+                analysis, total_tokens_per_image = future.result()
+            else:
+                source = analysis_results[reused_from]
+                delta = (window["start_frame"] - windows[reused_from]["start_frame"]) / fps
+                analysis, total_tokens_per_image = self.shift_analysis(source["analysis"], delta), 0
+            analysis_results.append(
+                self.make_window_result(window["start_frame"], window["end_frame"], fps, analysis, window_timecodes)
+            )
+            if reused_from is not None:
+                analysis_results[-1]["reused_from"] = reused_from
+            scene_context.add(analysis_results[-1])
+            print(f"[VideoAnalysis] - [run] - Analyzed combined frame from "
+                  f"{analysis_results[-1]['start_timecode']} to {analysis_results[-1]['end_timecode']}")
+            return total_tokens_per_image
+
+        try:
+            for window_index, window in enumerate(windows):
+                mosaic.reset()
             
-            timecodes = []
-            for i in range(frames_per_analysis):
-                frame_position = start_frame + i * frame_step
-                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_position)
-                ret, frame = cap.read()
+                timecodes = []
+                frames = sampler.read_at(window["frame_positions"])
+                for i, (frame_position, pts, frame) in enumerate(frames):
+                    # Расположение кадра в сетке 4x4
+                    mosaic.add(i, frame)
                 
-                if not ret:
-                    print(f"[VideoAnalysis] - [run] - End of video reached at frame {frame_position}")
+                    # Добавляем таймкод для текущего кадра (точный PTS декодированного кадра)
+                    timecode = self.format_timecode(pts)
+                    timecodes.append(timecode)
+
+                if len(timecodes) < len(window["frame_positions"]):
+                    print(f"[VideoAnalysis] - [run] - End of video reached at frame {sampler.position}")
+                if not timecodes:
                     break
-                
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(rgb_frame)
-                
-                # Расположение кадра в сетке 4x4
-                x = (i % 4) * frame_width
-                y = (i // 4) * frame_height
-                combined_image.paste(pil_image, (x, y))
-                
-                # Добавляем таймкод для текущего кадра
-                timecode = self.format_timecode(frame_position / fps)
-                timecodes.append(timecode)
-            
-            # Анализ объединенного изображения
-            combined_image.show()
-            analysis, total_tokens_per_image = self.image_analysis.analyze(
-                combined_image,
-                prompt_params={
-                    "scene": self.make_analysis_text(analysis_results),
-                    "timecodes": timecodes
-                },
-                resize_factor=resize_factor
-            )
-            total_tokens += total_tokens_per_image
-            
-            start_time = self.format_timecode(start_frame / fps)
-            end_time = self.format_timecode((start_frame + interval_frames) / fps)
-            
-            analysis_results.append({
-                "start_timecode": start_time,
-                "end_timecode": end_time,
-                "analysis": analysis,
-                "image_timecodes": timecodes
-            })
+
+                if deduplicator is not None:
+                    image_hash, reused_from = deduplicator.find(mosaic.buffer)
+                    if reused_from is not None:
+                        in_flight.append((None, window, timecodes, reused_from))
+                        continue
+                    deduplicator.add(image_hash, window_index)
+
+                # Не держим больше max_in_flight запросов одновременно
+                while len(in_flight) >= max(1, max_in_flight):
+                    total_tokens += collect_oldest()
             
-            print(f"[VideoAnalysis] - [run] - Analyzed combined frame from {start_time} to {end_time}")
+                # Анализ объединенного изображения (уже уменьшено, повторный resize не нужен)
+                future = executor.submit(
+                    self.image_analysis.analyze,
+                    mosaic.image(),
+                    prompt_params={
+                        "scene": scene_context.text(),
+                        "timecodes": timecodes
+                    },
+                    resize_factor=1
+                )
+                in_flight.append((future, window, timecodes, None))
+
+            while in_flight:
+                total_tokens += collect_oldest()
+        finally:
+            executor.shutdown(cancel_futures=True)
 
         cap.release()
         print("[VideoAnalysis] - [run] - Released video capture")
+        print(f"[VideoAnalysis] - [run] - Frame sampler stats: {sampler.stats()}")
+        print(f"[VideoAnalysis] - [run] - Scene context stats: {scene_context.stats()}")
+        if deduplicator is not None:
+            print(f"[VideoAnalysis] - [run] - Reused analysis for {deduplicator.reused} of {len(analysis_results)} windows")
 
         # Сохраняем результаты анализа в JSON файл
-        with open(output_json, 'w', encoding='utf-8') as json_file:
-            json.dump(analysis_results, json_file, ensure_ascii=False, indent=4)
-            print(f"[VideoAnalysis] - [run] - Saved analysis results to {output_json}")
+        if sink is not None:
+            sink.write(output_json, analysis_results)
+        elif output_json is not None:
+            with open(output_json, 'w', encoding='utf-8') as json_file:
+                json.dump(analysis_results, json_file, ensure_ascii=False, indent=4)
+                print(f"[VideoAnalysis] - [run] - Saved analysis results to {output_json}")
 
         return analysis_results, total_tokens
 
+    def make_window_result(self, start_frame: int, end_frame: int, fps: float,
+                           analysis: dict, timecodes: List[str]) -> dict:
+        return {
+            "start_timecode": self.format_timecode(start_frame / fps),
+            "end_timecode": self.format_timecode(end_frame / fps),
+            "analysis": analysis,
+            "image_timecodes": timecodes
+        }
+
+    def shift_analysis(self, analysis: dict, delta: float) -> dict:
+        """Копия анализа окна, у которой самый интересный отрезок сдвинут на delta секунд."""
+        analysis = dict(analysis)
+        fragment = analysis.get("most_interesting_fragment")
+        if isinstance(fragment, list):
+            analysis["most_interesting_fragment"] = [self.shift_timecode(timecode, delta) for timecode in fragment]
+        return analysis
+
+    def shift_timecode(self, timecode: str, delta: float) -> str:
+        """Сдвигает таймкод вида HH:MM:SS,mmm (или MM:SS); непонятные строки не трогает."""
+        try:
+            seconds = 0.0
+            for part in str(timecode).replace(",", ".").split(":"):
+                seconds = seconds * 60 + float(part)
+        except ValueError:
+            return timecode
+        return self.format_timecode(max(0.0, seconds + delta))
+
     @staticmethod
     def format_timecode(seconds: float) -> str:
         """Форматирует время в секундах в формат SRT таймкода."""